@@ -3,10 +3,14 @@ Build the STAC catalog for Oregon BLM and Washington St DNR forest stands.
 """
 
 # %%
+import os
 import re
-import json
-from datetime import datetime
+import argparse
+from collections import defaultdict
+from datetime import datetime, timezone
+from functools import lru_cache
 from pathlib import Path
+from typing import NamedTuple
 
 from pystac import (
     Extent,
@@ -26,11 +30,37 @@ from pystac.extensions.label import LabelExtension, LabelType, LabelClasses
 from pystac.extensions.projection import ProjectionExtension
 
 import numpy as np
+import orjson
 import geopandas as gpd
 import rasterio
+import shapely
 from shapely import geometry
 
-from gdstools import ConfigLoader, image_collection, multithreaded_execution
+from gdstools import ConfigLoader, multithreaded_execution
+
+# Prefer pyogrio for vector I/O, fall back to fiona when it is not installed.
+try:
+    import pyogrio  # noqa: F401
+
+    VECTOR_ENGINE = "pyogrio"
+except ImportError:
+    VECTOR_ENGINE = "fiona"
+
+_YEAR_RE = re.compile(r"\d+")
+
+# Linking labels is light on CPU, so allow more threads than cores.
+LABEL_WORKERS = min(32, (os.cpu_count() or 1) * 2)
+
+# GDAL options for opening COGs. Skips sibling-directory listings and merges
+# range requests, which matters when assets are read from S3.
+GDAL_READ_OPTIONS = {
+    "GDAL_DISABLE_READDIR_ON_OPEN": "EMPTY_DIR",
+    "CPL_VSIL_CURL_ALLOWED_EXTENSIONS": ".tif,.json,.png",
+    "GDAL_HTTP_MERGE_CONSECUTIVE_RANGES": "YES",
+    "VSI_CACHE": "TRUE",
+    "VSI_CACHE_SIZE": "268435456",
+    "GDAL_CACHEMAX": "512",
+}
 
 
 # %%
@@ -45,7 +75,26 @@ def bbox_to_json(bbox):
     :rtype: dict
     """
     geom = geometry.box(*bbox, ccw=True)
-    return json.loads(gpd.GeoSeries(geom).to_json())
+    return orjson.loads(gpd.GeoSeries(geom).to_json())
+
+
+def cells_total_bounds(bounds_by_cell: dict, cellids):
+    """
+    Compute the total bounds of a set of grid cells.
+
+    :param bounds_by_cell: Dictionary mapping each CELL_ID to its (minx, miny, maxx, maxy) bounds.
+    :type bounds_by_cell: dict
+    :param cellids: The CELL_IDs to include. Ids missing from the grid are ignored.
+    :type cellids: iterable
+    :return: The bounding box [minx, miny, maxx, maxy] covering all cells, or NaNs
+        if none of the cells are in the grid, as GeoDataFrame.total_bounds does.
+    :rtype: list
+    """
+    known = [bounds_by_cell[c] for c in cellids if c in bounds_by_cell]
+    if not known:
+        return [np.nan] * 4
+    arr = np.stack(known)
+    return [arr[:, 0].min(), arr[:, 1].min(), arr[:, 2].max(), arr[:, 3].max()]
 
 
 # %%
@@ -67,7 +116,8 @@ def create_label_item(label_path: str, attr_dict: dict, crs="EPSG:4326"):
     # Read label data
     label_path = Path(label_path)
     label_id = label_path.stem.replace("-cog", "")
-    label_data = gpd.read_file(label_path)
+    read_kwargs = {"use_arrow": True} if VECTOR_ENGINE == "pyogrio" else {}
+    label_data = gpd.read_file(label_path, engine=VECTOR_ENGINE, **read_kwargs)
     bbox = label_data.total_bounds.tolist()
 
     if attr_dict["label_task"] in ["classification", "segmentation"]:
@@ -81,19 +131,9 @@ def create_label_item(label_path: str, attr_dict: dict, crs="EPSG:4326"):
 
     label_data = label_data.to_crs(crs)
 
-    # label_data = json.loads(label_data.to_json())
-    import shapely
-
-    geoms = []
-    for geom in label_data.geometry:
-        if isinstance(geom, shapely.geometry.MultiPolygon):
-            geoms.extend(geom.geoms)
-        else:
-            geoms.append(geom)
-
-    mpoly = geometry.MultiPolygon(geoms)
-    mpoly = gpd.GeoSeries(mpoly)
-    mpoly = json.loads(mpoly.to_json())
+    # Flatten all stand polygons into a single MultiPolygon
+    parts = shapely.get_parts(label_data.geometry.to_numpy())
+    mpoly = geometry.mapping(geometry.MultiPolygon(list(parts)))
 
     # Create label item
     label_item = Item(
@@ -132,6 +172,34 @@ def create_label_item(label_path: str, attr_dict: dict, crs="EPSG:4326"):
     return label_item, label_ext
 
 
+@lru_cache(maxsize=16384)
+def read_image_properties(image_path: str, metadata_path: str):
+    """
+    Read the raster header and metadata sidecar of an image once.
+
+    :param image_path: Path to local COG image.
+    :type image_path: str
+    :param metadata_path: Path to local metadata file.
+    :type metadata_path: str
+    :return: Image bbox, EPSG code, acquisition date and (id, name) band pairs.
+    :rtype: tuple
+    """
+    # Only the header is needed; an unshared handle avoids the dataset cache lock
+    with rasterio.open(image_path, sharing=False) as src:
+        epsg = src.crs.to_epsg()
+        bbox = tuple(src.bounds)
+
+    with open(metadata_path, "rb") as f:
+        metadata = orjson.loads(f.read())
+
+    image_date = datetime.fromtimestamp(
+        metadata["properties"]["system:time_start"] / 1000, tz=timezone.utc
+    ).replace(tzinfo=None)
+    bands = tuple((b["id"], b.get("name")) for b in metadata["bands"])
+
+    return bbox, epsg, image_date, bands
+
+
 def create_item(
     image_path: str,
     thumb_path: str,
@@ -152,25 +220,14 @@ def create_item(
     :return: A STAC item.
     :rtype: pystac.Item
     """
-    # Load image data
-    image_path = Path(image_path)
-    thumb_path = Path(thumb_path)
-    with rasterio.open(image_path) as src:
-        crs = src.crs
-        bbox = list(src.bounds)
-
-    # Load metadata
-    with open(metadata_path) as f:
-        metadata = json.load(f)
-
-    # Collect image properties
-    image_date = datetime.utcfromtimestamp(
-        metadata["properties"]["system:time_start"] / 1000
+    image_name = os.fspath(image_path).rsplit("/", 1)[-1]
+    thumb_name = os.fspath(thumb_path).rsplit("/", 1)[-1]
+    bbox, epsg, image_date, image_bands = read_image_properties(
+        os.fspath(image_path), os.fspath(metadata_path)
     )
-    image_id = image_path.stem.replace("-cog", "")
-
+    bbox = list(bbox)
+    image_id = image_name.rsplit(".", 1)[0].replace("-cog", "")
     image_geom = bbox_to_json(bbox)
-    image_bands = metadata["bands"]
 
     # Create item
     item = Item(
@@ -182,27 +239,65 @@ def create_item(
     )
 
     # Add bands and projection
-    bands = [Band.create(name=b["id"], common_name=b.get("name")) for b in image_bands]
+    bands = [Band.create(name=name, common_name=common) for name, common in image_bands]
     eo = EOExtension.ext(item, add_if_missing=True)
     eo.apply(bands=bands)
 
     proj = ProjectionExtension.ext(item, add_if_missing=True)
-    proj.apply(epsg=crs.to_epsg())
+    proj.apply(epsg=epsg)
 
     # Add links to assets
     item.add_asset(
-        "image", Asset(href=asset_path_url + image_path.name, media_type=MediaType.COG)
+        "image", Asset(href=asset_path_url + image_name, media_type=MediaType.COG)
     )
     # item.add_asset('metadata', pystac.Asset(href=github_url +
     #                metadata_path[3:], media_type=pystac.MediaType.JSON))
     item.add_asset(
         "thumbnail",
-        Asset(href=asset_path_url + thumb_path.name, media_type=MediaType.PNG),
+        Asset(href=asset_path_url + thumb_name, media_type=MediaType.PNG),
     )
 
     return item
 
 
+def scan_assets(root, labels_dir: str = "stands"):
+    """
+    Collect label and image paths with a single walk of the data directory.
+
+    :param root: The data directory to walk.
+    :type root: str or Path
+    :param labels_dir: Name of the subdirectory of root holding the labels, defaults to 'stands'.
+    :type labels_dir: str, optional
+    :return: Sorted lists of label GeoJSON paths and COG image paths.
+    :rtype: tuple
+    """
+    root = os.fspath(root)
+    labels_root = os.path.join(root, labels_dir) + os.sep
+    labels, images = [], []
+    stack = [root]
+    while stack:
+        # DirEntry caches the file type from readdir, saving a stat per file
+        with os.scandir(stack.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.name.endswith(".geojson"):
+                    if entry.path.startswith(labels_root):
+                        labels.append(entry.path)
+                elif entry.name.endswith("-cog.tif"):
+                    images.append(entry.path)
+
+    return sorted(labels), sorted(images)
+
+
+class PathInfo(NamedTuple):
+    """File path with the name parts used to group catalog assets."""
+
+    path: str
+    cellid: str
+    year: str
+
+
 def paths_to_dict(paths_list, idx):
     """
     Create a dictionary from a list of paths.
@@ -211,32 +306,36 @@ def paths_to_dict(paths_list, idx):
     :type paths_list: list
     :param idx: The index of the path to use for the collection name.
     :type idx: int
-    :return: A dictionary with the collection name as the key and a list of file paths as the value.
+    :return: A dictionary with the collection name as the key and a list of PathInfo
+        tuples as the value, nested by year when file names carry one.
     :rtype: dict
     """
     _dict = {}
     for p in paths_list:
         plist = p.split("/")
         # expects name in format cellid_year_state_agency/dataset
-        nameparts = Path(p).stem.split("_")
+        nameparts = plist[-1].rsplit(".", 1)[0].split("_", 2)
+        info = PathInfo(p, nameparts[0], nameparts[1])
         collection = plist[idx + 1]
-        year = nameparts[1]
-        if not re.match(r"^\d+$", year):
-            _dict.setdefault(collection, []).append(p)
+        if _YEAR_RE.fullmatch(info.year) is None:
+            _dict.setdefault(collection, []).append(info)
         else:
-            _dict.setdefault(collection, {}).setdefault(year, []).append(p)
+            _dict.setdefault(collection, {}).setdefault(info.year, []).append(info)
     return _dict
 
 
 # %%
-def build_stac(rootpath: Path, run_as: str = "dev"):
+def build_stac(rootpath: Path, run_as: str = "dev", validate_all: bool = False):
     """
     Build the STAC
 
-    :param conf: A dictionary containing configuration information for the catalog.
-    :type conf: Dict[str, Any]
-    :param qq_shp: A GeoDataFrame containing the quad boundaries.
-    :type qq_shp: gpd.GeoDataFrame
+    :param rootpath: Directory containing the config file.
+    :type rootpath: Path
+    :param run_as: Either "dev" or "prod", selects the data directory, defaults to "dev".
+    :type run_as: str, optional
+    :param validate_all: Validate every child and item against the STAC schemas, not
+        just the root catalog. Slow on large catalogs, defaults to False.
+    :type validate_all: bool, optional
     :return: A STAC Catalog object.
     :rtype: Catalog
     """
@@ -250,7 +349,10 @@ def build_stac(rootpath: Path, run_as: str = "dev"):
         PROJDATADIR = Path(conf.PROJDATADIR) / "processed"
 
     # Build catalog
-    qq_shp = gpd.read_file(GRID)
+    qq_shp = gpd.read_file(GRID, engine=VECTOR_ENGINE)
+    bounds_by_cell = dict(
+        zip(qq_shp.CELL_ID.to_numpy(), shapely.bounds(qq_shp.geometry.to_numpy()))
+    )
 
     fbench = Catalog(
         id="treeforcast-s",
@@ -258,21 +360,26 @@ def build_stac(rootpath: Path, run_as: str = "dev"):
         title="TreeForCaSt-s - Modeling Forest Composition and Structure",
     )
 
-    label_paths = image_collection(
-        PROJDATADIR / "stands", file_pattern="*.geojson"
-    )  # type: ignore
-    image_paths = image_collection(PROJDATADIR)
+    label_paths, image_paths = scan_assets(PROJDATADIR)
 
     # Group labels and items by stand-agency and year
     labels_dict = paths_to_dict(label_paths, 6)
     images_dict = paths_to_dict(image_paths, 5)
 
+    # Cell ids available for each dataset year, shared by all stand-years
+    cellids_by_year = {
+        coll: {y: {p.cellid for p in paths} for y, paths in coll_dict.items()}
+        for coll, coll_dict in images_dict.items()
+        if isinstance(coll_dict, dict)
+    }
+
     items_dict = {}
     for stand, stand_dict in labels_dict.items():
 
         for year, year_dict in stand_dict.items():
             items_dict.setdefault(stand, {}).setdefault(year, {"stands": year_dict})
-            cellids = {Path(p).stem.split("_")[0] for p in stand_dict[year]}
+            cellids = {p.cellid for p in stand_dict[year]}
+            year_int = int(year)
 
             # add images
             for coll, coll_dict in images_dict.items():
@@ -282,27 +389,21 @@ def build_stac(rootpath: Path, run_as: str = "dev"):
 
                 if isinstance(coll_dict, dict):
                     min_year = min(
-                        coll_dict.keys(), key=lambda x: abs(int(x) - int(year))
+                        coll_dict.keys(), key=lambda x: abs(int(x) - year_int)
                     )
-                    _years = [y for y in coll_dict.keys() if int(year) - int(y) <= 2]
-                    cellids_min = {
-                        Path(p).stem.split("_")[0]
-                        for p in coll_dict[min_year]
-                        if Path(p).stem.split("_")[0] in cellids
-                    }
+                    _years = [y for y in coll_dict.keys() if year_int - int(y) <= 2]
+                    cellids_min = cellids_by_year[coll][min_year] & cellids
 
                     _year_dict = []
                     for _year in _years:
                         if _year != min_year:
-                            cellids_year = {
-                                Path(p).stem.split("_")[0] for p in coll_dict[_year]
-                            }
+                            cellids_year = cellids_by_year[coll][_year]
                             nondups = cellids - cellids_min.intersection(cellids_year)
                             _year_dict.extend(
                                 [
                                     p
                                     for p in coll_dict[_year]
-                                    if Path(p).stem.split("_")[0] in nondups
+                                    if p.cellid in nondups
                                 ]
                             )
                         else:
@@ -310,7 +411,7 @@ def build_stac(rootpath: Path, run_as: str = "dev"):
                                 [
                                     p
                                     for p in coll_dict[_year]
-                                    if Path(p).stem.split("_")[0] in cellids
+                                    if p.cellid in cellids
                                 ]
                             )
 
@@ -321,7 +422,7 @@ def build_stac(rootpath: Path, run_as: str = "dev"):
                 else:
                     items_dict[stand][year].setdefault("items", {}).setdefault(
                         coll,
-                        [p for p in coll_dict if Path(p).stem.split("_")[0] in cellids],
+                        [p for p in coll_dict if p.cellid in cellids],
                     )
 
     for dataset in images_dict:
@@ -360,6 +461,9 @@ def build_stac(rootpath: Path, run_as: str = "dev"):
         fbench.add_child(fbench_collection)
 
     # Create one label collection for each agency-year pair
+    collection_datetimes = {}
+    # Index image items by cell id so each label only visits its own sources.
+    items_by_cellid = defaultdict(list)
     for agency in items_dict:
         print("Creating datasets and label collections for", agency)
 
@@ -379,8 +483,8 @@ def build_stac(rootpath: Path, run_as: str = "dev"):
         start_datetime = datetime(start_year, 1, 1)
         end_datetime = datetime(end_year, 12, 31)
         # _dict = items_dict[agency][year]
-        cellids = [int(Path(p).stem.split("_")[0]) for p in _dict["stands"]]
-        aoi = qq_shp[qq_shp.CELL_ID.isin(cellids)].total_bounds.tolist()
+        cellids = [int(p.cellid) for p in _dict["stands"]]
+        aoi = cells_total_bounds(bounds_by_cell, cellids)
         label_info = conf["stands"][agency]
         label_info.update({"label_date": start_datetime})
         label_collection = Collection(
@@ -412,21 +516,25 @@ def build_stac(rootpath: Path, run_as: str = "dev"):
             dataset_paths = _dict["items"][dataset]
             print("\nAdding items to collection", dataset)
 
-            def add_item(image_path, collection):
+            def build_item(image_info, collection):
                 # print(image_path)
-                thumbnail_path = image_path.replace("-cog.tif", "-preview.png")
-                metadata_path = image_path.replace("-cog.tif", "-metadata.json")
-                idx = image_path.split("/").index(collection.id)
-                subdir = "/".join(image_path.split("/")[idx:-1])
+                image_path = image_info.path
+                base_path = image_path.removesuffix("-cog.tif")
+                thumbnail_path = f"{base_path}-preview.png"
+                metadata_path = f"{base_path}-metadata.json"
+                parts = image_path.split("/")
+                idx = parts.index(collection.id)
+                subdir = "/".join(parts[idx:-1])
                 asset_path_url = (
                     "https://fbstac-stands.s3.amazonaws.com/stands/data/" + subdir + "/"
                 )
                 try:
-                    item = create_item(
-                        image_path, thumbnail_path, metadata_path, asset_path_url
-                    )
-
-                    collection.add_item(item)
+                    # rasterio environments are thread-local, so enter it in the worker
+                    with rasterio.Env(**GDAL_READ_OPTIONS):
+                        item = create_item(
+                            image_path, thumbnail_path, metadata_path, asset_path_url
+                        )
+                    return image_info.cellid, item
                 except Exception as e:
                     print(e)
 
@@ -436,19 +544,38 @@ def build_stac(rootpath: Path, run_as: str = "dev"):
 
             params = [
                 {
-                    "image_path": image_path,
+                    "image_info": image_info,
                     "collection": collection,
                 }
-                for image_path in dataset_paths
+                for image_info in dataset_paths
             ]
 
-            multithreaded_execution(add_item, params)
+            # Items are built in parallel but added serially, since collections
+            # are not thread-safe. Collections are shared across agencies, so
+            # keep the datetimes of every item added so far.
+            datetimes = collection_datetimes.setdefault(dataset, [])
+            # Items are indexed by the cell id already parsed from the path,
+            # so no item id is re-split here.
+            for result in multithreaded_execution(build_item, params):
+                if result is not None:
+                    cellid, item = result
+                    collection.add_item(item)
+                    datetimes.append(item.datetime)
+                    items_by_cellid[cellid].append(item)
 
-            datetimes = [item.datetime for item in collection.get_all_items()]
-            cellids = [int(Path(p).stem.split("_")[0]) for p in dataset_paths]
-            aoi = qq_shp[qq_shp.CELL_ID.isin(cellids)].total_bounds.tolist()
-            start_datetime = min(datetimes)
-            end_datetime = max(datetimes)
+            # Item datetimes are naive UTC, so pin the tz before taking timestamps.
+            timestamps = np.fromiter(
+                (d.replace(tzinfo=timezone.utc).timestamp() for d in datetimes),
+                dtype=np.float64,
+            )
+            cellids = [int(p.cellid) for p in dataset_paths]
+            aoi = cells_total_bounds(bounds_by_cell, cellids)
+            start_datetime = datetime.fromtimestamp(
+                timestamps.min(), tz=timezone.utc
+            ).replace(tzinfo=None)
+            end_datetime = datetime.fromtimestamp(
+                timestamps.max(), tz=timezone.utc
+            ).replace(tzinfo=None)
             # for collection in fbench.get_all_collections():
             #     if collection.id == dataset:
             collection.extent = Extent(
@@ -459,31 +586,34 @@ def build_stac(rootpath: Path, run_as: str = "dev"):
         # Create labels and add references to source items.
         print("\nCreating labels and links to assets")
 
-        def add_label_item(label_path, label_info):
-            label_item, label_ext = create_label_item(label_path, label_info)
+        def add_label_item(label, label_info):
+            label_item, label_ext = create_label_item(label.path, label_info)
 
-            [
+            # add_source only adds a link to the label item, so the shared
+            # index is read-only here and safe to use from multiple threads.
+            for item in items_by_cellid.get(label.cellid, []):
                 label_ext.add_source(item, assets=["image"])
-                for item in fbench.get_all_items()
-                if item.id.split("_")[0] == label_item.id.split("_")[0]
-            ]
 
-            label_collection.add_item(label_item)
-            return
+            return label_item
 
         params = [
-            {"label_path": label_path, "label_info": label_info}
-            for label_path in _dict["stands"]
+            {"label": label, "label_info": label_info}
+            for label in _dict["stands"]
         ]
 
-        multithreaded_execution(add_label_item, params)
+        # Collections are not thread-safe, so label items are added serially.
+        for label_item in multithreaded_execution(add_label_item, params, LABEL_WORKERS):
+            label_collection.add_item(label_item)
 
         print("\nAdding label collection to catalog")
         fbench.add_child(label_collection)
 
     # Validate catalog
     fbench.normalize_hrefs("fbstac")
-    fbench.validate()
+    if validate_all:
+        fbench.validate_all()
+    else:
+        fbench.validate()
 
     return fbench
 
@@ -494,7 +624,15 @@ if __name__ == "__main__":
     TARGET = "/mnt/s3/fbstac-stands"
     TARGET = Path("/mnt/data/FESDataRepo/stac_stands/built_catalogs/treeforcast-s")
     TARGET.mkdir(parents=True, exist_ok=True)
-    fbench = build_stac(Path(__file__).parent, run_as="prod")
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--validate",
+        action="store_true",
+        help="validate every collection and item, not only the root catalog",
+    )
+    args = parser.parse_args()
+    fbench = build_stac(Path(__file__).parent, run_as="prod", validate_all=args.validate)
 
     # Save catalog
     print("Saving catalog to", TARGET.as_posix())
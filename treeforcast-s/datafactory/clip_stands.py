@@ -12,12 +12,72 @@ import os
 from pathlib import Path
 
 import geopandas as gpd
+import pandas as pd
+import shapely
 from gdstools import (
     ConfigLoader, 
     multithreaded_execution as mtexe,
     image_collection
 )
 
+# pyogrio writes much faster than fiona and releases the GIL while writing
+try:
+    import pyogrio
+except ImportError:
+    pyogrio = None
+
+WORKERS = os.cpu_count() or 1
+
+
+def clip_to_grid(foi, grid):
+    """Intersect stand polygons with the grid cells they touch.
+
+    Equivalent to ``gpd.overlay(foi, grid)``, but only candidate pairs from
+    the grid spatial index are intersected. Columns are laid out as in
+    overlay: stand attributes, grid attributes (suffixed with ``_2`` on
+    name clashes), then geometry.
+    """
+    ifoi, igrid = grid.sindex.query(foi.geometry, predicate='intersects')
+    geoms = shapely.intersection(
+        foi.geometry.to_numpy()[ifoi], grid.geometry.to_numpy()[igrid]
+    )
+
+    foi_attrs = foi.drop(columns=foi.geometry.name).iloc[ifoi]
+    grid_attrs = grid.drop(columns=grid.geometry.name).iloc[igrid]
+    grid_attrs = grid_attrs.rename(
+        columns={c: c + '_2' for c in grid_attrs.columns if c in foi_attrs.columns}
+    )
+    attrs = pd.concat(
+        [foi_attrs.reset_index(drop=True), grid_attrs.reset_index(drop=True)], axis=1
+    )
+    clipped = gpd.GeoDataFrame(attrs, geometry=geoms, crs=foi.crs)
+
+    # Keep only polygonal parts, dropping edges and corners shared with a cell
+    is_coll = clipped.geom_type == 'GeometryCollection'
+    if is_coll.any():
+        clipped.loc[is_coll, 'geometry'] = [
+            shapely.MultiPolygon([
+                g for g in shapely.get_parts(geom) 
+                if g.geom_type == 'Polygon'
+            ]) 
+            for geom in clipped.geometry[is_coll]
+        ]
+    is_poly = clipped.geom_type.isin(['Polygon', 'MultiPolygon'])
+    return clipped[is_poly & ~clipped.is_empty].reset_index(drop=True)
+
+
+def tiles_complete(manifest, stand):
+    """Check whether every tile listed in a stand map's manifest is on disk.
+
+    The manifest is written after all tiles of a stand map are saved. It is
+    ignored if the stand map was modified after it was written.
+    """
+    if not manifest.exists() or manifest.stat().st_mtime < stand.stat().st_mtime:
+        return False
+    names = manifest.read_text().split()
+    return all((manifest.parent / name).exists() for name in names)
+
+
 def main():
     # %%
     conf = ConfigLoader(Path(__file__).parent.parent).load()
@@ -32,15 +92,21 @@ def main():
         if cols is None:
             cols = gdf.columns
 
-        gdf[cols].to_file(filepath, driver='GeoJSON')
+        if pyogrio is not None:
+            pyogrio.write_dataframe(gdf[cols], filepath, driver='GeoJSON')
+        else:
+            gdf[cols].to_file(filepath, driver='GeoJSON')
         return
 
     standmaps = image_collection(STANDMAPSDIR, file_pattern="*.geojson")
     # standmaps.pop(0)
 
     grid = gpd.read_file(GRID).to_crs(crs=3857)
-    grid.insert(4, 'ST', grid.PRIMARY_STATE.apply(lambda x: x.upper()[:2]))
+    grid.insert(4, 'ST', grid['PRIMARY_STATE'].str.upper().str[:2])
     grid.insert(5, 'cell_area', grid.geometry.area)
+    # Build the grid's spatial index once, after reprojection, so every
+    # clip_to_grid call reuses the same tree.
+    grid.sindex
 
     for stand in standmaps:
         stand = Path(stand)
@@ -50,6 +116,12 @@ def main():
         AGENCY = stand.stem.split('_')[0]
         STATE = 'OR' if AGENCY == 'blm' else 'WA'
 
+        labels_path = Path(OUTPATH, 'processed/labels', AGENCY, YEAR)
+        manifest = labels_path / f'.{stand.stem}.tiles'
+        if tiles_complete(manifest, stand):
+            print("All tiles already saved. Skipping ...")
+            continue
+
         foi = gpd.read_file(stand).to_crs(crs=3857)
         
         # Rename grid columns to avoid conflicts with stand map columns
@@ -60,25 +132,28 @@ def main():
         if grid.columns[0] in foi.columns:
             grid.rename(columns={grid.columns[0]: grid.columns[0] + '_1'}, inplace=True)
 
-        foi_ovrly = gpd.overlay(foi, grid)
+        foi_ovrly = clip_to_grid(foi, grid)
         idx = foi_ovrly.columns.tolist().index(grid.columns[0])
         replace_cols = dict(zip(foi_ovrly.columns.tolist()[:idx], cols_bkup))
         foi_ovrly.rename(columns=replace_cols, inplace=True)
         keep_cols = foi_ovrly.columns.tolist()[:idx-2] + ['ST','geometry']
 
+        # Keep cells where stands cover at least 30% of the cell area
+        by_cell = foi_ovrly.geometry.area.groupby(foi_ovrly.CELL_ID)
+        stand_area = by_cell.sum()
+        cell_area = foi_ovrly.groupby('CELL_ID').cell_area.first()
+        keep_ids = stand_area.index[stand_area >= cell_area * 0.3]
+        # Reproject once for all tiles rather than once per tile
+        filtered = foi_ovrly[foi_ovrly.CELL_ID.isin(keep_ids)].to_crs(crs=4326)
+
         # Group by CELL_ID attribute
-        grouped = foi_ovrly.groupby('CELL_ID')
-        df_list = [
-            group for _, group in grouped 
-            if group.geometry.area.sum() >= (group.cell_area.iloc[0]) * 0.3
-        ]
+        df_list = [group for _, group in filtered.groupby('CELL_ID', sort=False)]
 
-        labels_path = Path(OUTPATH, 'processed/labels', AGENCY, YEAR)
         labels_path.mkdir(parents=True, exist_ok=True)
 
         params = [
             {
-                'gdf': df.to_crs(crs=4326),
+                'gdf': df,
                 'filepath': labels_path / f'{df.CELL_ID.iloc[0]}_{YEAR}_{df.ST.iloc[0].lower()}_{AGENCY}_stands.geojson',
                 'cols': keep_cols
             }
@@ -86,7 +161,10 @@ def main():
         ] 
 
         # %%
-        mtexe(save_tile, params)
+        mtexe(save_tile, params, WORKERS)
+
+        # Record the tiles written for this stand map so reruns can skip it
+        manifest.write_text('\n'.join(p['filepath'].name for p in params))
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
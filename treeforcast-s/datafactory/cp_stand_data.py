@@ -1,11 +1,34 @@
 import os
+import argparse
 from pathlib import Path
+import asyncio
 import shutil
 
+import boto3
+from aiobotocore.session import get_session
+from boto3.s3.transfer import TransferConfig
 from pystac import Catalog
 
 from gdstools import ConfigLoader, multithreaded_execution
 
+# Copies are I/O-bound, so oversubscribing the CPUs is fine.
+WORKERS = min(32, (os.cpu_count() or 1) * 4)
+COPY_BUFSIZE = 8 * 1024 * 1024
+
+BUCKET = 'fbstac-stands'
+ROOT_HREF = f'https://{BUCKET}.s3.amazonaws.com'
+# Catalog assets live under this href (see build_stac asset_path_url)
+ASSETS_HREF = f'{ROOT_HREF}/stands/data'
+# Requests kept in flight at once when uploading straight to S3
+MAX_CONCURRENCY = 64
+# Files larger than this go through boto3's multipart transfer
+MULTIPART_THRESHOLD = 8 * 1024 * 1024
+TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=MULTIPART_THRESHOLD,
+    multipart_chunksize=16 * 1024 * 1024,
+    max_concurrency=10,
+)
+
 
 def copy_asset(src, dst, overwrite=False):
     print(f'Copying {Path(src).name} to {dst}')
@@ -17,13 +40,71 @@ def copy_asset(src, dst, overwrite=False):
     Path(dst).parent.mkdir(parents=True, exist_ok=True)
 
     try:
-        shutil.copy(src, dst)
+        # Large buffer writes are much faster than the default on the S3 mount
+        with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+            shutil.copyfileobj(fsrc, fdst, length=COPY_BUFSIZE)
+        shutil.copymode(src, dst)
     except Exception as e:
         print(f'Error copying file {src}. Exception raised: {e}')
         
     return
 
-def main(root):
+
+def parse_key(href):
+    """Return the S3 object key of an asset href in the catalog bucket."""
+    return href.replace(ROOT_HREF + '/', '', 1)
+
+
+async def list_keys(s3, prefix):
+    """Collect the keys already uploaded under prefix."""
+    keys = set()
+    paginator = s3.get_paginator('list_objects_v2')
+    async for page in paginator.paginate(Bucket=BUCKET, Prefix=prefix):
+        keys.update(obj['Key'] for obj in page.get('Contents', []))
+    return keys
+
+
+async def upload_asset(s3, s3_sync, sem, src, key, existing, overwrite=False):
+    if key in existing and not overwrite:
+        print(f'Object {key} aready exist. Skipping ...')
+        return
+
+    async with sem:
+        print(f'Uploading {Path(src).name} to s3://{BUCKET}/{key}')
+        try:
+            if os.path.getsize(src) > MULTIPART_THRESHOLD:
+                await asyncio.to_thread(
+                    s3_sync.upload_file, src, BUCKET, key, Config=TRANSFER_CONFIG
+                )
+            else:
+                body = await asyncio.to_thread(Path(src).read_bytes)
+                await s3.put_object(Bucket=BUCKET, Key=key, Body=body)
+        except Exception as e:
+            print(f'Error uploading file {src}. Exception raised: {e}')
+
+    return
+
+
+async def upload_assets(sources, keys, prefix, overwrite=False):
+    """Upload assets to the catalog bucket with many requests in flight.
+
+    Only keys under prefix are listed to find what is already uploaded.
+    """
+    session = get_session()
+    # boto3 clients are thread-safe, but creating them is not
+    s3_sync = boto3.client('s3')
+    async with session.create_client('s3') as s3:
+        existing = await list_keys(s3, prefix)
+        sem = asyncio.Semaphore(MAX_CONCURRENCY)
+        await asyncio.gather(*[
+            upload_asset(s3, s3_sync, sem, src, key, existing, overwrite=overwrite)
+            for src, key in zip(sources, keys)
+        ])
+
+    return
+
+
+def main(root, upload=False):
     conf = ConfigLoader(root).load()
     root_catalog = Catalog.from_file(os.path.join(conf.CATALOG_PATH, 'catalog.json'))
     prjdir = Path(conf.PROJDATADIR)
@@ -39,9 +120,16 @@ def main(root):
     hrefs = [[a[k].href for k in a.keys()] for a in assets]
     hrefs = [h for sublist in hrefs for h in sublist] 
 
-    root_href = 'https://fbstac-stands.s3.amazonaws.com'
-    sources = [img.replace(root_href + '/data', prjdir.as_posix()) for img in hrefs]
-    targets = [img.replace(root_href, conf.CATALOG_PATH) for img in hrefs]
+    sources = [img.replace(ROOT_HREF + '/data', prjdir.as_posix()) for img in hrefs]
+
+    if upload:
+        # Upload straight to S3 instead of through the mount
+        keys = [parse_key(img) for img in hrefs]
+        asyncio.run(upload_assets(sources, keys, parse_key(ASSETS_HREF) + '/'))
+        return
+
+    # Copy through the S3 bucket mounted at CATALOG_PATH
+    targets = [img.replace(ROOT_HREF, conf.CATALOG_PATH) for img in hrefs]
 
     params = [
         {
@@ -51,11 +139,18 @@ def main(root):
         for src, dst in zip(sources, targets)
     ]
 
-    multithreaded_execution(copy_asset, params)
+    multithreaded_execution(copy_asset, params, WORKERS)
 
     return
 
 if __name__ == '__main__':
-    
+    parser = argparse.ArgumentParser(description='Copy catalog assets to the S3 bucket.')
+    parser.add_argument(
+        '--upload',
+        action='store_true',
+        help='upload with concurrent S3 requests instead of copying through the mount',
+    )
+    args = parser.parse_args()
+
     root = Path(__file__).parent.parent
-    main(root)
+    main(root, upload=args.upload)
@@ -8,12 +8,13 @@ from typing import Union, Tuple
 import requests
 from pathlib import Path
 import contextlib
-from functools import partial
+from functools import lru_cache, partial
 from multiprocessing.pool import ThreadPool
 from PIL import Image
 import matplotlib.pyplot as plt
 
 import numpy as np
+import orjson
 import geopandas as gpd
 import rasterio
 from rasterio import MemoryFile
@@ -585,14 +586,26 @@ def classify_landform(tpi_near, tpi_far, slope):
 
 
 def center_crop_array(new_size, array):
-    """Crops an array to a new size, centered on the original array.
+    """Crops the last two axes of an array to a new size, centered on the
+    original array. Returns a view.
     """
-    xpad, ypad = (np.subtract(array.shape, new_size)/2).astype(int)
-    dx, dy = np.subtract(new_size, array[xpad:-xpad, ypad:-ypad].shape)
-    return array[xpad:-xpad+dx, ypad:-ypad+dy]
+    h, w = array.shape[-2:]
+    nh, nw = new_size
+    y0, x0 = (h - nh) // 2, (w - nw) // 2
+    return array[..., y0:y0 + nh, x0:x0 + nw]
 
 
 # %%
+@lru_cache(maxsize=None)
+def dem_service_metadata():
+    """Fetch and parse the 3DEP ImageServer description once per run."""
+    URL = 'https://elevation.nationalmap.gov/arcgis/'\
+          'rest/services/3DEPElevation/ImageServer?f=pjson'
+    r = requests.get(URL)
+    r.raise_for_status()
+    return orjson.loads(r.content)
+
+
 def fetch_metadata(filename, bands, res, out_dir='.'):
     """Fetch DEM metadata from the 3Dep web service and write to disk.
         # id
@@ -616,18 +629,13 @@ def fetch_metadata(filename, bands, res, out_dir='.'):
     :return: True if metadata file was successfully written to disk.
     :rtype: bool
     """ 
-    import requests
-    import json
     import calendar
     from datetime import datetime
 
     month_name = {month: index for index,
                   month in enumerate(calendar.month_name) if month}
 
-    URL = 'https://elevation.nationalmap.gov/arcgis/'\
-          'rest/services/3DEPElevation/ImageServer?f=pjson'
-    r = requests.get(URL)
-    src_metadata = r.json()
+    src_metadata = dem_service_metadata()
 
     metadata = {}
     for key in src_metadata.keys():
@@ -652,8 +660,8 @@ def fetch_metadata(filename, bands, res, out_dir='.'):
         }
     )
 
-    with open(os.path.join(out_dir, filename), "w") as f:
-        f.write(json.dumps(metadata, indent=4))
+    with open(os.path.join(out_dir, filename), "wb") as f:
+        f.write(orjson.dumps(metadata, option=orjson.OPT_INDENT_2))
 
     return True
 
@@ -859,7 +867,7 @@ if __name__ == '__main__':
     labels = image_collection(PROJDATADIR, file_pattern='*.geojson')
     cellids = [int(Path(x).name.split('_')[0]) for x in labels]
 
-    gdf['PRIMARY_STATE'] = gdf.PRIMARY_STATE.apply(lambda x: x.upper()[:2])
+    gdf['PRIMARY_STATE'] = gdf['PRIMARY_STATE'].str.upper().str[:2]
     # cellids = [264178,248505,241042,173189]
     gdf = gdf[gdf.CELL_ID.isin(cellids)]
 
@@ -1,8 +1,10 @@
 # %%
 from pathlib import Path
 from datetime import datetime
+from functools import lru_cache
 import json
 
+import pandas as pd
 import geopandas as gpd
 import ee
 
@@ -15,6 +17,42 @@ from gdstools import (
 )
 
 # %%
+@lru_cache(maxsize=None)
+def gfl_collection():
+    """Return the Gap-Filled Landsat collection, shared by all requests.
+
+    Built lazily because Earth Engine objects can only be created after
+    ``ee.Initialize``.
+    """
+    return ee.ImageCollection("projects/KalmanGFwork/GFLandsat_V1")
+
+
+@lru_cache(maxsize=None)
+def season_dates(year, season):
+    """Return the start and end dates and timestamps of a season.
+
+    :param year: Year (e.g. 2019)
+    :type year: int
+    :param season: Either "leafon" or "leafoff"
+    :type season: str
+    :return: Start date, end date, and their POSIX timestamps in seconds.
+    :rtype: tuple
+    """
+    if season == "leafoff":
+        start_date = f"{year - 1}-10-01"
+        end_date = f"{year}-03-31"
+    elif season == "leafon":
+        start_date = f"{year}-04-01"
+        end_date = f"{year}-09-30"
+    else:
+        raise ValueError(f"Invalid season: {season}")
+
+    ts_start = datetime.timestamp(datetime.strptime(start_date, "%Y-%m-%d"))
+    ts_end = datetime.timestamp(datetime.strptime(end_date, "%Y-%m-%d"))
+
+    return start_date, end_date, ts_start, ts_end
+
+
 def get_gflandsat(
     bbox,
     year,
@@ -47,25 +85,8 @@ def get_gflandsat(
     metadata : dict
         Image metadata.
     """
-    # TODO: define method to get collection, then pass an instance of that 
-    # collection to the GEEImageLoader to avoid instantiating the collection
-    # every time this function is called.
-
-    if season == "leafoff":
-        start_date = f"{year - 1}-10-01"
-        end_date = f"{year}-03-31"
-    elif season == "leafon":
-        start_date = f"{year}-04-01"
-        end_date = f"{year}-09-30"
-    else:
-        raise ValueError(f"Invalid season: {season}")
-
-    collection = ee.ImageCollection("projects/KalmanGFwork/GFLandsat_V1").filterDate(
-        start_date, end_date
-    )
-
-    ts_start = datetime.timestamp(datetime.strptime(start_date, "%Y-%m-%d"))
-    ts_end = datetime.timestamp(datetime.strptime(end_date, "%Y-%m-%d"))
+    start_date, end_date, ts_start, ts_end = season_dates(year, season)
+    collection = gfl_collection().filterDate(start_date, end_date)
 
     bbox = ee.Geometry.BBox(*bbox)
     image = GEEImageLoader(collection.median().clip(bbox))
@@ -117,12 +138,17 @@ if __name__ == "__main__":
     # %%
     # Fetch data only for labels cellids
     labels = image_collection(PROJDATADIR, file_pattern='*.geojson')
-    cellids = [int(Path(x).name.split('_')[0]) for x in labels]
-    years = set([Path(x).name.split('_')[1] for x in labels])
+    # Label names start with <cellid>_<year>_
+    label_ids = pd.Series(labels, dtype=str).str.extract(r'(?:^|/)(\d+)_(\d+)_[^/]*$')
+    cellids = label_ids[0].astype(int).tolist()
+    years = set(label_ids[1].tolist())
 
     # Load QQ shapefile
-    gdf['STATE'] = gdf.PRIMARY_STATE.apply(lambda x: x.upper()[:2])
+    gdf['STATE'] = gdf['PRIMARY_STATE'].str.upper().str[:2]
     gdf = gdf[gdf.CELL_ID.isin(cellids)]
+    bounds = gdf.bounds.to_numpy()
+    cellids = gdf.CELL_ID.to_numpy()
+    states = gdf.STATE.to_numpy()
 
     # Overwrite years if needed
     years = [2021, 2022]
@@ -148,13 +174,22 @@ if __name__ == "__main__":
         # qq_shp = qq_shp[qq_shp.CELL_ID.isin(qq_shp.head(20).CELL_ID)].copy()
         params = [
             {
-                "bbox": row.geometry.bounds,
+                "bbox": tuple(bbox),
                 "year": year,
                 "out_path": out_path,
-                "prefix": f"{row.CELL_ID}_{year}_{row.STATE}",
+                "prefix": f"{cellid}_{year}_{state}",
                 "season": "leafon",
                 "overwrite": False,
-            } for row in gdf.itertuples()
+            } for bbox, cellid, state in zip(bounds, cellids, states)
+        ]
+
+        # Skip tiles already saved by a previous run.
+        existing = {
+            p.name.removesuffix("-cog.tif") for p in out_path.glob("*-cog.tif")
+        }
+        params = [
+            p for p in params
+            if f"{p['prefix']}_Gap_Filled_Landsat_{p['season']}" not in existing
         ]
 
         multithreaded_execution(get_gflandsat, params, WORKERS)
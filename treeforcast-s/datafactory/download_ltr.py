@@ -2,10 +2,12 @@
 Fetch LandTrendr data from Google Earth Engine (GEE) for each tile in the USGS 7.5 min grid.
 """
 # %%
-import os
+from functools import lru_cache
 from pathlib import Path
+import pandas as pd
 import geopandas as gpd
 import ee
+from copy import deepcopy
 from typing import Union
 
 from gdstools import (
@@ -61,18 +63,19 @@ def parse_landtrendr_result(
     # combine segments in the timeseries
     seg_info = ee.Image.cat([ysd, mag, dur, rate]).toArray(0).mask(is_vertex.mask())
 
-    # sort by magnitude of disturbance
-    sort_by_this = seg_info.arraySlice(0, 1, 2).toArray(0)
-    seg_info_sorted = seg_info.arraySort(
-        sort_by_this.multiply(-1)
-    )  # flip to sort in descending order
-    biggest_loss = seg_info_sorted.arraySlice(1, 0, 1)
-
-    img = ee.Image.cat(
-        biggest_loss.arraySlice(0, 0, 1).arrayProject([1]).arrayFlatten([["ysd"]]),
-        biggest_loss.arraySlice(0, 1, 2).arrayProject([1]).arrayFlatten([["mag"]]),
-        biggest_loss.arraySlice(0, 2, 3).arrayProject([1]).arrayFlatten([["dur"]]),
-        biggest_loss.arraySlice(0, 3, 4).arrayProject([1]).arrayFlatten([["rate"]]),
+    # pick the segment with the largest magnitude; argmax returns the first
+    # maximum, matching the stable descending sort it replaces
+    mag_row = seg_info.arraySlice(0, 1, 2)
+    # pixels with fewer than two vertices have no segments to pick from;
+    # mask them before argmax so they are left as nodata
+    has_segments = mag_row.arrayLength(1).gt(0)
+    idx = mag_row.updateMask(has_segments).arrayArgmax().arrayGet([1])
+    biggest_loss = seg_info.arraySlice(1, idx, idx.add(1))
+
+    img = (
+        biggest_loss.arrayProject([0])
+        .arrayFlatten([["ysd", "mag", "dur", "rate"]])
+        .updateMask(has_segments)
     )
 
     if big_fast:
@@ -95,6 +98,176 @@ def parse_landtrendr_result(
 
 
 # %%
+LT_PARAMS = {
+    "maxSegments": 6,
+    "spikeThreshold": 0.9,
+    "vertexCountOvershoot": 3,
+    "preventOneYearRecovery": True,
+    "recoveryThreshold": 0.25,
+    "pvalThreshold": 0.05,
+    "bestModelProportion": 0.75,
+    "minObservationsNeeded": 6,
+}
+
+
+@lru_cache(maxsize=None)
+def landsat_collections(bbox: tuple, year: int, epsg:int=4326):
+    """Build the SWIR1 and NBR Landsat collections for an area once.
+
+    Tiles passing the same bbox (e.g. their state's bounds) share the
+    collections instead of each rebuilding its own filters.
+
+    :param bbox: bounding box of the area the collections cover
+    :type bbox: tuple
+    :param year: last year of the time series
+    :type year: int
+    :param epsg: EPSG code of the bbox, defaults to 4326
+    :type epsg: int, optional
+    :return: the SWIR1 and NBR collections
+    :rtype: tuple
+    """
+    aoi = ee.Geometry.Rectangle(bbox, proj=f"EPSG:{epsg}", evenOdd=True, geodesic=False)
+    swir_coll = get_landsat_collection(aoi, 1984, year, band="SWIR1")
+    nbr_coll = get_landsat_collection(aoi, 1984, year, band="NBR")
+
+    return swir_coll, nbr_coll
+
+
+def landtrendr_image(year: int, swir_coll: ee.ImageCollection, nbr_coll: ee.ImageCollection):
+    """Run LandTrendr on SWIR1 and NBR collections and stack the results.
+
+    :param year: last year of the time series
+    :type year: int
+    :param swir_coll: SWIR1 Landsat collection
+    :type swir_coll: ee.ImageCollection
+    :param nbr_coll: NBR Landsat collection
+    :type nbr_coll: ee.ImageCollection
+    :return: the 8-band LandTrendr image
+    :rtype: ee.Image
+    """
+    swir_result = ee.Algorithms.TemporalSegmentation.LandTrendr(swir_coll, **LT_PARAMS)
+    nbr_result = ee.Algorithms.TemporalSegmentation.LandTrendr(nbr_coll, **LT_PARAMS)
+
+    swir_img = parse_landtrendr_result(swir_result, year).set(
+        "system:time_start", swir_coll.first().get("system:time_start")
+    )
+    nbr_img = parse_landtrendr_result(nbr_result, year, flip_disturbance=True).set(
+        "system:time_start", nbr_coll.first().get("system:time_start")
+    )
+
+    lt_img = ee.Image.cat(
+        swir_img.select(["ysd"], ["ysd_swir1"]),
+        swir_img.select(["mag"], ["mag_swir1"]),
+        swir_img.select(["dur"], ["dur_swir1"]),
+        swir_img.select(["rate"], ["rate_swir1"]),
+        nbr_img.select(["ysd"], ["ysd_nbr"]),
+        nbr_img.select(["mag"], ["mag_nbr"]),
+        nbr_img.select(["dur"], ["dur_nbr"]),
+        nbr_img.select(["rate"], ["rate_nbr"]),
+    ).set("system:time_start", swir_img.get("system:time_start"))
+
+    return lt_img
+
+
+def landtrendr_metadata(bbox: tuple, year: int, epsg:int=4326):
+    """Fetch the metadata of the NBR collection shared by an area's tiles.
+
+    :param bbox: bounding box the shared collections were built over
+    :type bbox: tuple
+    :param year: last year of the time series
+    :type year: int
+    :param epsg: EPSG code of the bbox, defaults to 4326
+    :type epsg: int, optional
+    :return: the collection metadata
+    :rtype: dict
+    """
+    _, nbr_coll = landsat_collections(tuple(bbox), year, epsg)
+    loader = GEEImageLoader(nbr_coll.first())
+    loader.metadata_from_collection(nbr_coll)
+
+    return loader.metadata
+
+
+def landtrendr_asset_id(asset_root: str, state: str, year: int):
+    """Asset id of the precomputed state-wide LandTrendr image."""
+    return f"{asset_root}/LT_{state}_{year}"
+
+
+@lru_cache(maxsize=None)
+def asset_exists(asset_id: str):
+    """Check once per run whether a GEE asset is available."""
+    try:
+        ee.data.getAsset(asset_id)
+    except ee.EEException:
+        return False
+    return True
+
+
+@lru_cache(maxsize=None)
+def active_exports():
+    """Descriptions of the export tasks still queued or running in GEE.
+
+    Listed once per run, since each state and year is exported at most once.
+    """
+    active = (ee.batch.Task.State.READY, ee.batch.Task.State.RUNNING)
+    return frozenset(
+        task.config.get("description")
+        for task in ee.batch.Task.list()
+        if task.state in active
+    )
+
+
+def export_state_landtrendr(
+        state_bbox: tuple,
+        state: str,
+        year: int,
+        asset_root: str,
+        epsg:int=4326,
+        scale:int=30,
+    ):
+    """Export a state-wide LandTrendr image to a GEE asset.
+
+    Adjacent tiles share Landsat scenes, so segmenting the whole state once
+    lets every tile be clipped from the same result instead of re-running
+    LandTrendr per tile.
+
+    :param state_bbox: bounding box of the state's tiles
+    :type state_bbox: tuple
+    :param state: two-letter state code
+    :type state: str
+    :param year: year to fetch data for
+    :type year: int
+    :param asset_root: GEE folder to export the asset to
+    :type asset_root: str
+    :param epsg: EPSG code of the projection, defaults to 4326
+    :type epsg: int, optional
+    :param scale: scale of the image, defaults to 30
+    :type scale: int, optional
+    :return: the started export task, or None if the asset already exists or
+        is still being exported
+    :rtype: ee.batch.Task
+    """
+    asset_id = landtrendr_asset_id(asset_root, state, year)
+    description = f"LT_{state}_{year}"
+    if asset_exists(asset_id) or description in active_exports():
+        return
+
+    aoi = ee.Geometry.Rectangle(state_bbox, proj=f"EPSG:{epsg}", evenOdd=True, geodesic=False)
+    lt_img = landtrendr_image(year, *landsat_collections(tuple(state_bbox), year, epsg))
+    task = ee.batch.Export.image.toAsset(
+        image=lt_img.clip(aoi),
+        description=description,
+        assetId=asset_id,
+        region=aoi,
+        scale=scale,
+        crs=f"EPSG:{epsg}",
+        maxPixels=1e13,
+    )
+    task.start()
+
+    return task
+
+
 def get_landtrendr(
         bbox: tuple, 
         year: int, 
@@ -102,7 +275,11 @@ def get_landtrendr(
         prefix:str=None, 
         epsg:int=4326, 
         scale:int=30, 
-        overwrite:bool=False
+        overwrite:bool=False,
+        state:str=None,
+        asset_root:str=None,
+        collection_bbox:tuple=None,
+        metadata:dict=None,
     ):
     """Fetch LandTrendr data
 
@@ -120,51 +297,36 @@ def get_landtrendr(
     :type scale: int, optional
     :param overwrite: whether to overwrite existing files, defaults to False
     :type overwrite: bool, optional
+    :param state: two-letter state code of the tile, defaults to None
+    :type state: str, optional
+    :param asset_root: GEE folder holding state-wide LandTrendr exports. When
+        the state's asset exists the tile is clipped from it, otherwise
+        LandTrendr is computed for the tile, defaults to None
+    :type asset_root: str, optional
+    :param collection_bbox: bounds to build the Landsat collections over, so
+        tiles passing the same bounds share them, defaults to the tile bbox
+    :type collection_bbox: tuple, optional
+    :param metadata: collection metadata shared by the tile's state, from
+        landtrendr_metadata. Fetched from the tile's own NBR collection when
+        None, defaults to None
+    :type metadata: dict, optional
     :return: None
     :rtype: None
     """ 
     # %%
     filename = f"{prefix}LandTrendr_8B_SWIR1-NBR_{year}"
-    if os.path.exists(out_path / f'{filename}-cog.tif') & (not overwrite):
-        print(f"File {out_path} already exists. Skipping.")
-        return
 
     aoi = ee.Geometry.Rectangle(bbox, proj=f"EPSG:{epsg}", evenOdd=True, geodesic=False)
-    swir_coll = get_landsat_collection(aoi, 1984, year, band="SWIR1")
-    nbr_coll = get_landsat_collection(aoi, 1984, year, band="NBR")
-
-    LT_PARAMS = {
-        "maxSegments": 6,
-        "spikeThreshold": 0.9,
-        "vertexCountOvershoot": 3,
-        "preventOneYearRecovery": True,
-        "recoveryThreshold": 0.25,
-        "pvalThreshold": 0.05,
-        "bestModelProportion": 0.75,
-        "minObservationsNeeded": 6,
-    }
-
-    swir_result = ee.Algorithms.TemporalSegmentation.LandTrendr(swir_coll, **LT_PARAMS)
-    nbr_result = ee.Algorithms.TemporalSegmentation.LandTrendr(nbr_coll, **LT_PARAMS)
-
-    swir_img = parse_landtrendr_result(swir_result, year).set(
-        "system:time_start", swir_coll.first().get("system:time_start")
-    )
-    nbr_img = parse_landtrendr_result(nbr_result, year, flip_disturbance=True).set(
-        "system:time_start", nbr_coll.first().get("system:time_start")
-    )
-
-    lt_img = ee.Image.cat(
-        swir_img.select(["ysd"], ["ysd_swir1"]),
-        swir_img.select(["mag"], ["mag_swir1"]),
-        swir_img.select(["dur"], ["dur_swir1"]),
-        swir_img.select(["rate"], ["rate_swir1"]),
-        nbr_img.select(["ysd"], ["ysd_nbr"]),
-        nbr_img.select(["mag"], ["mag_nbr"]),
-        nbr_img.select(["dur"], ["dur_nbr"]),
-        nbr_img.select(["rate"], ["rate_nbr"]),
-    ).set("system:time_start", swir_img.get("system:time_start"))
+    asset_id = None
+    if asset_root and state:
+        asset_id = landtrendr_asset_id(asset_root, state, year)
 
+    if asset_id and asset_exists(asset_id):
+        lt_img = ee.Image(asset_id)
+    else:
+        lt_img = landtrendr_image(
+            year, *landsat_collections(tuple(collection_bbox or bbox), year, epsg)
+        )
     try:
         image = GEEImageLoader(lt_img.clip(aoi))
     except Exception as e:
@@ -172,7 +334,13 @@ def get_landtrendr(
         return
     
     # Set image metadata and params
-    image.metadata_from_collection(nbr_coll)
+    if metadata is not None:
+        # Copied so each tile's properties don't leak into the shared dict
+        image.metadata = deepcopy(metadata)
+    else:
+        image.metadata_from_collection(
+            get_landsat_collection(aoi, 1984, year, band="NBR")
+        )
     image.set_params("scale", scale)
     image.set_params("crs", f"EPSG:{epsg}")
     image.set_viz_params("min", 200)
@@ -193,8 +361,8 @@ def get_landtrendr(
 
     image.id = filename
 
-    image.to_geotif(out_path)
-    image.save_preview(out_path)
+    image.to_geotif(out_path, overwrite=overwrite)
+    image.save_preview(out_path, overwrite=overwrite)
     image.save_metadata(out_path)
 
     return
@@ -205,6 +373,9 @@ if __name__ == "__main__":
     run_as = "prod"
     conf = ConfigLoader(Path(__file__).parent.parent).load()
     ltr_api = conf['items']['landtrendr']['providers']['Google']['api']
+    # GEE folder for state-wide LandTrendr exports; tiles fall back to
+    # per-tile segmentation while an export is missing or still running.
+    ltr_assets = conf['items']['landtrendr']['providers']['Google'].get('assets')
     qq_shp = gpd.read_file(conf.GRID)
 
     if run_as == "dev":
@@ -222,11 +393,17 @@ if __name__ == "__main__":
     # %%
     # Load the QQ grid shapefile. Fetch data only for labels cellids
     labels = image_collection(PROJDATADIR / "labels", file_pattern='*.geojson')
-    cellids = [int(Path(x).name.split('_')[0]) for x in labels]
-    years = set([int(Path(x).name.split('_')[1]) for x in labels])
+    # Label names start with <cellid>_<year>_
+    label_ids = pd.Series(labels, dtype=str).str.extract(r'(?:^|/)(\d+)_(\d+)_[^/]*$').astype(int)
+    cellids = label_ids[0].tolist()
+    years = set(label_ids[1].tolist())
 
-    qq_shp['STATE'] = qq_shp.PRIMARY_STATE.apply(lambda x: x.upper()[:2])
+    qq_shp['STATE'] = qq_shp['PRIMARY_STATE'].str.upper().str[:2]
     qq_shp = qq_shp[qq_shp.CELL_ID.isin(cellids)]
+    # Landsat collections are built once per state and shared by its tiles
+    state_bounds = {
+        state: tuple(tiles.total_bounds) for state, tiles in qq_shp.groupby("STATE")
+    }
 
     # Overwrite years 
     years = [2021, 2022]
@@ -234,15 +411,40 @@ if __name__ == "__main__":
     for year in years:
         ltr_path = create_directory_tree(PROJDATADIR, "landtrendr", str(year))
 
+        if ltr_assets:
+            for state, state_bbox in state_bounds.items():
+                export_state_landtrendr(state_bbox, state, year, ltr_assets)
+
         params = [
             {
                 "bbox": row.geometry.bounds,
                 "year": year,
                 "out_path": ltr_path,
                 "prefix": f"{row.CELL_ID}_{year}_{row.STATE}_",
+                "state": row.STATE,
+                "asset_root": ltr_assets,
+                "collection_bbox": state_bounds[row.STATE],
             }
             for row in qq_shp.itertuples()
         ]
 
+        # Skip tiles saved by a previous run before they reach the pool
+        done = {p.name for p in ltr_path.glob("*-cog.tif")}
+        params = [
+            p for p in params
+            if f"{p['prefix']}LandTrendr_8B_SWIR1-NBR_{p['year']}-cog.tif" not in done
+        ]
+
+        # Collection metadata is fetched once per state and shared by its
+        # tiles; tiles of a state whose request failed fetch their own
+        state_metadata = {}
+        for state in {p["state"] for p in params}:
+            try:
+                state_metadata[state] = landtrendr_metadata(state_bounds[state], year)
+            except Exception as e:
+                print(f"Failed to fetch metadata for {state} {year}: {e}")
+        for p in params:
+            p["metadata"] = state_metadata.get(p["state"])
+
         # %%
         multithreaded_execution(get_landtrendr, params, WORKERS)
@@ -6,20 +6,25 @@ import os
 from pathlib import Path
 from typing import Union
 from datetime import datetime
-from functools import partial
+from functools import lru_cache, partial
 from PIL import Image
-import json
+import orjson
 
 from multiprocessing.pool import ThreadPool
+from concurrent.futures import ThreadPoolExecutor
+import threading
 import time
 
 import ee
 from affine import Affine
+import pandas as pd
 import geopandas as gpd
+import rasterio
 from shapely.geometry import box
+from shapely.ops import transform
 import numpy as np
 
-from pyproj import CRS
+from pyproj import CRS, Transformer
 
 from gdstools import (
     split_bbox,
@@ -30,6 +35,18 @@ from gdstools import (
     multithreaded_execution,
 )
 
+# Prefer pyogrio for vector I/O, fall back to fiona when it is not installed.
+try:
+    import pyogrio  # noqa: F401
+    VECTOR_ENGINE = "pyogrio"
+except ImportError:
+    VECTOR_ENGINE = "fiona"
+
+# GEE rejects interactive requests beyond its per-project concurrency quota,
+# so cap the requests in flight across all tiles and quadrant threads.
+GEE_MAX_REQUESTS = 40
+_gee_requests = threading.BoundedSemaphore(GEE_MAX_REQUESTS)
+
 def timeit(method):
     """Decorator that times the execution of a method and prints the time taken."""
     def timed(*args, **kwargs):
@@ -47,7 +64,8 @@ def naip_from_gee(
     dim:int=1,
     num_threads:int=8,
     epsg:int=4326,
-    scale:int=1
+    scale:int=1,
+    date_range:tuple=None
 ):
     """
     Fetch NAIP image url from Google Earth Engine (GEE) using a bounding box.
@@ -60,6 +78,9 @@ def naip_from_gee(
     :type epsg: int, optional
     :param scale: Resolution in meters of the image to fetch. Default is 1.
     :type scale: int, optional
+    :param date_range: Prefetched (ts_start, ts_end) of the images in the bounding box, in
+        milliseconds. If None, it is requested from GEE. Default is None.
+    :type date_range: tuple, optional
     :return: Returns a tuple containing the image as a numpy array and its metadata as a dictionary.
     :rtype: Tuple[np.ndarray, Dict]
     """
@@ -74,17 +95,33 @@ def naip_from_gee(
         .filterBounds(eebbox)
     )
 
-    assert collection.size().getInfo() > 0, f"No images found for {year}"
+    with _gee_requests:
+        n_images = collection.size().getInfo()
+    assert n_images > 0, f"No images found for {year}"
     
-    date_range = collection.reduceColumns(ee.Reducer.minMax(), ['system:time_start'])
-    ts_end, ts_start = date_range.getInfo().values()
+    median_image = collection.median()
+
+    # Fetch the date range while the quadrants are downloading, unless it was
+    # prefetched with naip_date_ranges
+    if date_range is None:
+        date_range_query = collection.reduceColumns(
+            ee.Reducer.minMax(), ['system:time_start']
+        )
+
+        def fetch_date_range():
+            with _gee_requests:
+                return date_range_query.getInfo()
+
+        executor = ThreadPoolExecutor(max_workers=1)
+        date_range_info = executor.submit(fetch_date_range)
+        # The submitted query still runs; this only frees the thread after it
+        executor.shutdown(wait=False)
 
-    
     try: 
-        image = GEEImageLoader(collection.median().clip(eebbox))
+        image = GEEImageLoader(median_image.clip(eebbox))
 
         imarray, profile = quad_fetch(
-            collection, 
+            median_image, 
             bbox, 
             dim=dim, 
             num_threads=num_threads, 
@@ -94,6 +131,12 @@ def naip_from_gee(
     except Exception as e:
         raise Exception(f"Failed to fetch NAIP image: {e}")
 
+    if date_range is None:
+        info = date_range_info.result()
+        date_range = (info['min'], info['max'])
+
+    ts_start, ts_end = date_range
+
     image.metadata_from_collection(collection)
     image.set_property("system:time_start", ts_start)# * 1000)
     image.set_property("system:time_end", ts_end)# * 1000)
@@ -108,8 +151,47 @@ def naip_from_gee(
     return imarray, image.metadata
 
 
+def naip_date_ranges(bboxes: list, year: int, chunk_size: int = 500):
+    """
+    Fetch the acquisition date range of the NAIP images over each bounding box
+    from Google Earth Engine (GEE), one request per chunk of bounding boxes.
+
+    :param bboxes: Bounding boxes in the form [xmin, ymin, xmax, ymax].
+    :type bboxes: list
+    :param year: Year (e.g. 2019)
+    :type year: int
+    :param chunk_size: Number of bounding boxes reduced per request (default is 500)
+    :type chunk_size: int
+    :return: A (ts_start, ts_end) tuple in milliseconds for each bounding box,
+        or None for the boxes of a chunk whose request failed.
+    :rtype: list
+    """
+    collection = ee.ImageCollection("USDA/NAIP/DOQQ").filterDate(
+        f"{year}-01-01", f"{year}-12-31"
+    )
+    date_ranges = []
+    for i in range(0, len(bboxes), chunk_size):
+        chunk = bboxes[i:i + chunk_size]
+        try:
+            with _gee_requests:
+                ranges = ee.List([
+                    collection.filterBounds(ee.Geometry.BBox(*bbox)).reduceColumns(
+                        ee.Reducer.minMax(), ['system:time_start']
+                    )
+                    for bbox in chunk
+                ]).getInfo()
+        except Exception as e:
+            # get_naip fetches the date range itself when given None
+            print(f"Failed to fetch date ranges for tiles {i}-{i + len(chunk) - 1}: {e}")
+            date_ranges.extend([None] * len(chunk))
+            continue
+        date_ranges.extend((r.get('min'), r.get('max')) for r in ranges)
+
+    return date_ranges
+
+
 def quad_fetch(
-        collection:ee.Collection, 
+        median_image:ee.Image, 
         bbox: tuple, 
         dim:int=1, 
         num_threads:int=None, 
@@ -119,8 +201,8 @@ def quad_fetch(
     Breaks user-provided bounding box into quadrants and retrieves data
     using `fetcher` for each quadrant in parallel using a ThreadPool.
 
-    :param collection: Earth Engine image collection.
-    :type collection: ee.Collection
+    :param median_image: Median composite of the Earth Engine image collection.
+    :type median_image: ee.Image
     :param bbox: Coordinates of x_min, y_min, x_max, and y_max for bounding box of tile.
     :type bbox: tuple
     :param dim: Dimension of the quadrants to split the bounding box into. Default is 1.
@@ -133,10 +215,11 @@ def quad_fetch(
     """
     def clip_image(bbox, scale, epsg):
         ee_bbox = ee.Geometry.BBox(*bbox)
-        image = GEEImageLoader(collection.median().clip(ee_bbox))
+        image = GEEImageLoader(median_image.clip(ee_bbox))
         image.set_params("scale", scale)
         image.set_params("crs", f"EPSG:{epsg}")
-        return image.to_array()
+        with _gee_requests:
+            return image.to_array()
 
     if dim > 1:
         if num_threads is None:
@@ -148,18 +231,21 @@ def quad_fetch(
         with ThreadPool(num_threads) as p:
             quads = p.map(get_quads, bboxes)
 
-        # Split quads list in tuples of size dim
-        images = [x[0] for x in quads]
-        quad_list = [images[x:x + dim] for x in range(0, len(images), dim)]
-
-        # Reverse order of rows to match rasterio's convention
-        [x.reverse() for x in quad_list]
-        image = np.concatenate(
-            [
-                np.hstack(quad_list[x]) for x in range(0, len(quad_list))
-            ],
-            2
+        # Quads come in columns of size dim, ordered bottom to top. Copy each
+        # one straight into its slice of the mosaic, reversing the rows to
+        # match rasterio's convention.
+        first_img = quads[0][0]
+        heights = [quads[r][0].shape[1] for r in range(dim)]
+        widths = [quads[c * dim][0].shape[2] for c in range(dim)]
+        row_offsets = np.cumsum([0] + heights[::-1])[::-1][1:]
+        col_offsets = np.cumsum([0] + widths)[:-1]
+        image = np.empty(
+            (first_img.shape[0], sum(heights), sum(widths)), dtype=first_img.dtype
         )
+        for i, (img, _) in enumerate(quads):
+            c, r = divmod(i, dim)
+            y0, x0 = row_offsets[r], col_offsets[c]
+            image[:, y0:y0 + img.shape[1], x0:x0 + img.shape[2]] = img
 
         profile = quads[0][1]
         first = quads[0][1]['transform']
@@ -188,7 +274,9 @@ def get_naip(
     outpath: Union[str, Path], 
     dim:int=3, 
     overwrite:bool=False, 
-    num_threads:int=None
+    num_threads:int=None,
+    date_range:tuple=None,
+    cog_threads:Union[int, str]='ALL_CPUS'
 ):
     """
     Downloads a NAIP image from Google Earth Engine and saves it as a Cloud-Optimized GeoTIFF (COG) file.
@@ -211,6 +299,12 @@ def get_naip(
     :param num_threads: int, optional
         number of threads to use for downloading (default is None)
     :type num_threads: int
+    :param date_range: tuple, optional
+        prefetched (ts_start, ts_end) of the images in the bounding box (default is None)
+    :type date_range: tuple
+    :param cog_threads: int or str, optional
+        GDAL threads used to compress the COG (default is 'ALL_CPUS')
+    :type cog_threads: int or str
 
     :return: None
     :rtype: None
@@ -221,25 +315,30 @@ def get_naip(
 
     outpath = Path(outpath)
     try:
-        image, metadata = naip_from_gee(bbox, dim=dim, year=year, num_threads=num_threads)
+        image, metadata = naip_from_gee(
+            bbox, dim=dim, year=year, num_threads=num_threads, date_range=date_range
+        )
     except Exception as e:
         print(f"Failed to fetch {outpath.name}: {e}")
         return
 
+    # Downsample 30x with a block mean before handing the RGB bands to PIL
+    h, w = image.shape[1] // 30, image.shape[2] // 30
+    rgb = image[:3, :h * 30, :w * 30].reshape(3, h, 30, w, 30).mean(axis=(2, 4))
     preview = Image.fromarray(
-        np.moveaxis(image[:3], 0, -1).astype(np.uint8)
-    ).convert('RGB')
-    h, w = preview.size
-    preview = preview.resize((w//30, h//30))
+        np.ascontiguousarray(np.moveaxis(rgb, 0, -1)).astype(np.uint8)
+    )
     preview.save(outpath.parent / outpath.name.replace('-cog.tif',
-                 '-preview.png'), optimize=True)
+                 '-preview.png'), compress_level=1)
     profile = metadata['properties']['profile']
     metadata['properties'].pop('profile')
 
-    with open(outpath.parent / outpath.name.replace('-cog.tif', '-metadata.json'), 'w') as f:
-        json.dump(metadata, f, indent=2)
+    with open(outpath.parent / outpath.name.replace('-cog.tif', '-metadata.json'), 'wb') as f:
+        f.write(orjson.dumps(metadata, option=orjson.OPT_INDENT_2 | orjson.OPT_SERIALIZE_NUMPY))
         
-    save_cog(image, profile, outpath, overwrite=overwrite)
+    # Compress the COG and build its overviews on cog_threads cores
+    with rasterio.Env(GDAL_NUM_THREADS=str(cog_threads), GDAL_TIFF_OVR_BLOCKSIZE='512'):
+        save_cog(image, profile, outpath, overwrite=overwrite)
 
     return
 
@@ -249,6 +348,9 @@ def infer_utm(bbox:tuple):
     Infer the UTM Coordinate Reference System (CRS) by determining
     the UTM zone where a given lat/long bounding box is located.
 
+    Only WGS84 northern hemisphere zones (EPSG:326xx) are returned, and the
+    bounding box is expected in EPSG:4326.
+
     :param bbox: list-like
         List of bounding box coordinates (minx, miny, maxx, maxy)
     :type bbox: list-like
@@ -257,31 +359,18 @@ def infer_utm(bbox:tuple):
         UTM crs for the bounding box
     :rtype: pyproj.CRS
     """
-    xmin, _, xmax, _ = bbox
-    midpoint = (xmax - xmin) / 2
-
-    if xmax <= -120 + midpoint:
-        epsg = 32610
-    elif (xmin + midpoint > -120) and (xmax <= -114 + midpoint):
-        epsg = 32611
-    elif (xmin + midpoint > -114) and (xmax <= -108 + midpoint):
-        epsg = 32612
-    elif (xmin + midpoint > -108) and (xmax <= -102 + midpoint):
-        epsg = 32613
-    elif (xmin + midpoint > -102) and (xmax <= -96 + midpoint):
-        epsg = 32614
-    elif (xmin + midpoint > -96) and (xmax <= -90 + midpoint):
-        epsg = 32615
-    elif (xmin + midpoint > -90) and (xmax <= -84 + midpoint):
-        epsg = 32616
-    elif (xmin + midpoint > -84) and (xmax <= -78 + midpoint):
-        epsg = 32617
-    elif (xmin + midpoint > -78) and (xmax <= -72 + midpoint):
-        epsg = 32618
-    elif xmin + midpoint > -72:
-        epsg = 32619
-
-    return CRS.from_epsg(epsg)
+    midpoint = (bbox[0] + bbox[2]) / 2
+    zone = int((midpoint + 180) // 6) + 1
+
+    return CRS.from_epsg(32600 + zone)
+
+
+@lru_cache(maxsize=64)
+def _utm_transformer(epsg:int, inverse:bool=False):
+    """Build (once per zone) the transformer between EPSG:4326 and a UTM zone."""
+    if inverse:
+        return Transformer.from_crs(epsg, 4326, always_xy=True)
+    return Transformer.from_crs(4326, epsg, always_xy=True)
 
 
 def bbox_padding(geom:object, padding:int=1e3):
@@ -299,12 +388,12 @@ def bbox_padding(geom:object, padding:int=1e3):
         A tuple of four floats representing the padded bounding box coordinates (minx, miny, maxx, maxy).
     :rtype: tuple
     """
-    p_crs = infer_utm(geom.bounds)
-    p_geom = gpd.GeoSeries(geom, crs=4326).to_crs(p_crs)
+    epsg = infer_utm(geom.bounds).to_epsg()
+    p_geom = transform(_utm_transformer(epsg).transform, geom)
     if padding > 0:
         p_geom = p_geom.buffer(padding, join_style=2)
 
-    return p_geom.to_crs(4326).bounds.values[0]
+    return transform(_utm_transformer(epsg, inverse=True).transform, p_geom).bounds
 
 
 if "__main__" == __name__:
@@ -313,7 +402,7 @@ if "__main__" == __name__:
     conf = ConfigLoader(Path(__file__).parent.parent).load()
     api_url = conf['items']['naip']['providers']['Google']['api']
     GRID = conf.GRID
-    qq_shp = gpd.read_file(GRID)
+    qq_shp = gpd.read_file(GRID, engine=VECTOR_ENGINE)
 
     if run_as == "dev":
         PROJDATADIR = Path(conf.DEV_PROJDATADIR) 
@@ -324,13 +413,20 @@ if "__main__" == __name__:
     elif run_as == "prod":
         GRID = conf.GRID
         PROJDATADIR = Path(conf.PROJDATADIR) / "processed"
-        WORKERS = 3
+        # Downloads are I/O-bound, so oversubscribing the CPUs is fine.
+        # Requests in flight are capped separately by GEE_MAX_REQUESTS.
+        WORKERS = min(32, (os.cpu_count() or 1) * 4)
         # Load the QQ grid shapefile. Fetch data only for labels cellids
         labels = image_collection(PROJDATADIR / "labels", file_pattern='*.geojson')
-        cellids = [int(Path(x).name.split('_')[0]) for x in labels]
-        years = set([int(Path(x).name.split('_')[1]) for x in labels])
+        # Label names start with <cellid>_<year>_
+        label_ids = pd.Series(labels, dtype=str).str.extract(r'(?:^|/)(\d+)_(\d+)_[^/]*$').astype(int)
+        cellids = label_ids[0].tolist()
+        years = set(label_ids[1].tolist())
+
+    # Each worker compresses its COG on its share of the CPUs
+    COG_THREADS = str(max(1, (os.cpu_count() or 1) // WORKERS))
 
-    qq_shp['STATE'] = qq_shp.PRIMARY_STATE.apply(lambda x: str(x)[:2])
+    qq_shp['STATE'] = qq_shp['PRIMARY_STATE'].astype(str).str[:2]
     qq_shp = qq_shp[qq_shp.CELL_ID.isin(cellids)]
 
     ee.Initialize(opt_url=api_url)
@@ -349,8 +445,16 @@ if "__main__" == __name__:
                 "year": year,
                 "outpath": outpath / f"{row.CELL_ID}_{year}_{row.STATE.upper()}_NAIP_DOQQ-cog.tif",
                 "num_threads": 11,
-                "overwrite": False
+                "overwrite": False,
+                "cog_threads": COG_THREADS,
             } for row in qq_shp.itertuples()
         ]
+        # Tiles already on disk are skipped by get_naip, so don't query them
+        params = [p for p in params if not p["outpath"].exists()]
+
+        # Fetch the date ranges for the remaining tiles in a few round trips
+        date_ranges = naip_date_ranges([p["bbox"] for p in params], year)
+        for p, date_range in zip(params, date_ranges):
+            p["date_range"] = date_range
 
         multithreaded_execution(get_naip, params, WORKERS)
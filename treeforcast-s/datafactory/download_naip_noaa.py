@@ -1,18 +1,23 @@
 # %%
+import copy
+import os
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
-import json
+from functools import partial
 import geopandas as gpd
 from pathlib import Path
 import rasterio
 from rasterio import transform
-from rasterio import MemoryFile
-from rasterio.warp import reproject, Resampling
+from rasterio.enums import Resampling
+from rasterio.vrt import WarpedVRT
 from rio_cogeo.cogeo import cog_translate
 from rio_cogeo.profiles import cog_profiles
-from rasterio import windows
 import numpy as np
+import orjson
+import pandas as pd
 from pyproj import CRS
 from PIL import Image
+import shapely
 from shapely.geometry import mapping
 
 from gdstools import image_collection, degrees_to_meters
@@ -20,204 +25,231 @@ from gdstools import image_collection, degrees_to_meters
 # %%
 STATE = 'WA'
 PROJDATADIR = Path('/mnt/data/FESDataRepo/stac_stands/processed')
+# GDAL's HTTP reads are unreliable across threads, so tiles go to processes.
+WORKERS = min(8, os.cpu_count() or 1)
+# Compression threads per worker, so WORKERS processes share the CPUs
+COG_THREADS = str(max(1, (os.cpu_count() or 1) // WORKERS))
+# Warp buffer per worker, in MB, so WORKERS processes fit in RAM together
+WARP_MEM_LIMIT = 256
+# Remote NAIP reads: skip directory listings, merge adjacent range requests
+# and cache fetched blocks so each window costs as few HTTP GETs as possible
+GDAL_READ_OPTIONS = {
+    'GDAL_DISABLE_READDIR_ON_OPEN': 'EMPTY_DIR',
+    'CPL_VSIL_CURL_ALLOWED_EXTENSIONS': '.tif',
+    'CPL_VSIL_CURL_CACHE_SIZE': '200000000',
+    'GDAL_HTTP_MERGE_CONSECUTIVE_RANGES': 'YES',
+    'GDAL_INGESTED_BYTES_AT_OPEN': '393216',
+    'VSI_CACHE': 'TRUE',
+    'VSI_CACHE_SIZE': '268435456',
+}
 
 def center_crop_array(new_size, array):
-    xpad, ypad = (np.subtract(array.shape, new_size)/2).astype(int)
-    dx, dy = np.subtract(new_size, array[xpad:-xpad, ypad:-ypad].shape)
-    return array[xpad:-xpad+dx, ypad:-ypad+dy]
+    """Crops the last two axes of an array to a new size, centered on the
+    original array. Returns a view.
+    """
+    h, w = array.shape[-2:]
+    nh, nw = new_size
+    y0, x0 = (h - nh) // 2, (w - nw) // 2
+    return array[..., y0:y0 + nh, x0:x0 + nw]
 
 crs2927 = CRS.from_epsg(2927)
 crs4326 = CRS.from_epsg(4326)
-if STATE == 'WA':
-    YEAR = '2021'
-    tindex = gpd.read_file('/mnt/data/FESDataRepo/raw/noaa_naip/tileindex_WA_NAIP_2021.shp').to_crs(crs2927)
-    grid = gpd.read_file('/mnt/data/FESDataRepo/stac_stands/interim/usgs_grid/USGS_CellGrid_3_75Minute_WA_epsg4326.geojson').to_crs(crs2927)
-    print('Fetching NAIP imagery for Washington St')
-elif STATE == 'OR':
-    YEAR = '2020'
-    tindex = gpd.read_file('/mnt/data/FESDataRepo/raw/noaa_naip/tile_index_OR_NAIP_2020_9504.shp').to_crs(crs2927)
-    grid = gpd.read_file('/mnt/data/FESDataRepo/stac_stands/interim/usgs_grid/USGS_CellGrid_3_75Minute_OR_epsg4326.geojson').to_crs(crs2927)
-    print('Fetching NAIP imagery for Oregon')
-
-# Get the intersection of the two maps
-tindex.columns = [c.upper() for c in tindex.columns if c != 'geometry'] + ['geometry']
-grid_tidx = gpd.overlay(grid, tindex, how='intersection')
-grid_tidx['area'] = grid_tidx.geometry.area
-grid_tidx = grid_tidx.sort_values(['CELL_ID', 'area']).groupby('CELL_ID').last().reset_index()
-grid = grid.merge(grid_tidx[['CELL_ID', 'URL']], on='CELL_ID')
-grid = grid.to_crs(crs4326)
-
-labels = image_collection(PROJDATADIR / "labels", file_pattern='*.geojson')
-cellids = [int(Path(x).name.split('_')[0]) for x in labels]
-
-# Skip downloaded naip
-downloaded = image_collection(PROJDATADIR / f"naip/{YEAR}", file_pattern='*.tif')
-downloaded_cellids = [int(Path(x).name.split('_')[0]) for x in downloaded]
-cellids = list(set(cellids) - set(downloaded_cellids))
-
-grid = grid[grid.CELL_ID.isin(cellids)]
-
-cog_profile = cog_profiles.get("deflate")
-
-for i, row in grid.iterrows():
-
-    outfile = PROJDATADIR / f"naip/{YEAR}" / f"{row.CELL_ID}_{YEAR}_{STATE}_NAIP_NOAA-cog.tif"
-    outfile.parent.mkdir(parents=True, exist_ok=True)
-
-    geom = grid[grid.index == i].geometry.values[0]
-    bbox = row.geometry.bounds
-
-    print('Fetching', row.CELL_ID, 'from', row.URL)
-    with rasterio.open(row.URL) as src:
-        geom = gpd.GeoSeries(geom, crs=4326).to_crs(src.crs)
-        xmin, ymin, xmax, ymax = geom[0].bounds
-        src_w = src.shape[1]
-        src_h = src.shape[0]
-
-        prop = src_h / src_w
-        p_width = ((xmax - xmin) / src.res[1])
-        p_height = ((ymax - ymin) / src.res[0])
-
-        col_off = (src_w - p_width) / 2
-        row_off = (src_h - p_height) / 2
-
-        src_transform = transform.from_bounds(xmin, ymin, xmax, ymax, p_width, p_height)
-        window = windows.Window(col_off, row_off, p_width, p_height) 
-        data = src.read(window=window)
 
+NAIP_DESCRIPTION = "<p>The National Agriculture Imagery Program (NAIP) acquires aerial imagery\nduring the agricultural growing seasons in the continental U.S.</p><p>NAIP projects are contracted each year based upon available funding and the\nimagery acquisition cycle. Beginning in 2003, NAIP was acquired on\na 5-year cycle. 2008 was a transition year, and a three-year cycle began\nin 2009.</p><p>NAIP imagery is acquired at a one-meter ground sample distance (GSD) with a\nhorizontal accuracy that matches within six meters of photo-identifiable\nground control points, which are used during image inspection.</p><p>Older images were collected using 3 bands (Red, Green, and Blue: RGB), but\nnewer imagery is usually collected with an additional near-infrared band\n(RGBN). RGB asset ids begin with &#39;n<em>&#39;, NRG asset ids begin with &#39;c</em>&#39;, RGBN\nasset ids begin with &#39;m_&#39;.</p><p><b>Provider: <a href=\"https://www.fsa.usda.gov/programs-and-services/aerial-photography/imagery-programs/naip-imagery/\">USDA Farm Production and Conservation - Business Center, Geospatial Enterprise Operations</a></b><br><p><b>Resolution</b><br>1 meter\n</p><p><b>Bands</b><table class=\"eecat\"><tr><th scope=\"col\">Name</th><th scope=\"col\">Description</th></tr><tr><td>R</td><td><p>Red</p></td></tr><tr><td>G</td><td><p>Green</p></td></tr><tr><td>B</td><td><p>Blue</p></td></tr><tr><td>N</td><td><p>Near infrared</p></td></tr></table><p><b>Terms of Use</b><br><p>Most information presented on the FSA Web site is considered public domain\ninformation. Public domain information may be freely distributed or copied,\nbut use of appropriate byline/photo/image credits is requested. For more\ninformation visit the <a href=\"https://www.fsa.usda.gov/help/policies-and-links\">FSA Policies and Links</a>\nwebsite.</p><p>Users should acknowledge USDA Farm Production and Conservation -\nBusiness Center, Geospatial Enterprise Operations when using or\ndistributing this data set.</p><p><b>Suggested citation(s)</b><ul><li><p>USDA Farm Production and Conservation - Business Center, Geospatial Enterprise Operations</p></li></ul><style>\n  table.eecat {\n  border: 1px solid black;\n  border-collapse: collapse;\n  font-size: 13px;\n  }\n  table.eecat td, tr, th {\n  text-align: left; vertical-align: top;\n  border: 1px solid gray; padding: 3px;\n  }\n  td.nobreak { white-space: nowrap; }\n</style>"
+
+# Per-tile fields (band origins, footprint and dates) are filled in by
+# process_row on a deep copy.
+NAIP_METADATA_TEMPLATE = {
+    "type": "ImageCollection",
+    "bands": [
+        {
+        "id": band_id,
+        "data_type": {
+            "type": "PixelType",
+            "precision": "double",
+            "min": 0,
+            "max": 255
+        },
+        "dimensions": [1,1],
+        "origin": None,
+        "crs": "EPSG:4326",
+        "crs_transform": [1,0,0,0,1,0]
+        }
+        for band_id in "RGBN"
+    ],
+    "properties": {
+        "system:footprint": {
+        "geodesic": 'false',
+        "type": "Polygon",
+        "coordinates": None
+        },
+        "system:time_start": None,
+        "system:time_end": None,
+        "description": NAIP_DESCRIPTION
+    },
+    "id": "image"
+}
+
+
+def process_row(row, year, state, out_dir, cog_profile):
+    """Clip, reproject and save the NAIP COG, preview and metadata for one cell.
+
+    `row` is a plain dict with CELL_ID, URL and geometry so the whole grid
+    does not have to be pickled for every worker.
+    """
+    cellid = row['CELL_ID']
+    url = row['URL']
+
+    outfile = out_dir / f"{cellid}_{year}_{state}_NAIP_NOAA-cog.tif"
+
+    geom = row['geometry']
+    bbox = geom.bounds
+
+    print('Fetching', cellid, 'from', url)
+    with rasterio.Env(**GDAL_READ_OPTIONS), rasterio.open(url) as src:
+        res_x, res_y = src.res
         width = int(np.ceil(degrees_to_meters(bbox[2]-bbox[0])/src.res[0]))
         height = int(np.ceil(degrees_to_meters(bbox[-1]-bbox[1])/src.res[1]))
 
         dst_transform = transform.from_bounds(*bbox, width, height)
 
-        PROFILE = {
-            'driver': 'GTiff',
-            'interleave': 'band',
-            'tiled': True,
-            'crs': crs4326,
-            'transform': dst_transform,
-            'width': width,
-            'height': height,
-            'blockxsize': 256,
-            'blockysize': 256,
-            'compress': 'lzw',
-            'count': src.count,
-            'dtype': rasterio.uint8,
-        }
-
-        print('Writing', outfile)
-        with MemoryFile() as memfile:
-            with memfile.open(**PROFILE) as dst:
-                output = np.zeros((src.count, height, width), rasterio.uint8)
-                reproject(
-                    source=data,#np.array(bands),
-                    destination=output,#rasterio.band(dst, i+1),
-                    src_transform=src_transform,#.window_transform(window),
-                    src_crs=src.crs,
-                    dst_transform=dst_transform,
-                    dst_crs=rasterio.crs.CRS.from_epsg(4326),
-                    resampling=Resampling.bilinear
-                )
-                dst.write(output)
-
-                cog_translate(
-                    dst,
-                    outfile,
-                    cog_profile,
-                    in_memory=True,
-                    quiet=True
-                )
-
-
-                # Generate and save preview
-                print('Writing preview ...')
-                preview = Image.fromarray(
-                    np.moveaxis(output[:3], 0, -1)).convert('RGB')
-                h, w = preview.size
-                # Change preview res to 30m
-                new_w = int(w * src.res[0] / 30)
-                new_h = int(h * src.res[1] / 30)
-                preview = preview.resize((new_w, new_h))
-                preview.save(outfile.parent / outfile.name.replace('-cog.tif',
-                            '-preview.png'), optimize=True)
-
-
-                # Generate and save metadata
-                print('Writing metadata ...')
-                xoff, yoff = (dst_transform.xoff, dst_transform.yoff)
-                coordinates = mapping(row.geometry)['coordinates'][0][0]
-                date = datetime.strptime(
-                    row.URL.split('_')[-1].replace('.tif',''), "%Y%m%d")
-                unixdate = int(datetime.timestamp(date)*1000)
-
-                metadata = {
-                    "type": "ImageCollection",
-                    "bands": [
-                        {
-                        "id": "R",
-                        "data_type": {
-                            "type": "PixelType",
-                            "precision": "double",
-                            "min": 0,
-                            "max": 255
-                        },
-                        "dimensions": [1,1],
-                        "origin": [xoff, yoff],
-                        "crs": "EPSG:4326",
-                        "crs_transform": [1,0,0,0,1,0]
-                        },
-                        {
-                        "id": "G",
-                        "data_type": {
-                            "type": "PixelType",
-                            "precision": "double",
-                            "min": 0,
-                            "max": 255
-                        },
-                        "dimensions": [1,1],
-                        "origin": [xoff, yoff],
-                        "crs": "EPSG:4326",
-                        "crs_transform": [1,0,0,0,1,0]
-                        },
-                        {
-                        "id": "B",
-                        "data_type": {
-                            "type": "PixelType",
-                            "precision": "double",
-                            "min": 0,
-                            "max": 255
-                        },
-                        "dimensions": [1,1],
-                        "origin": [xoff, yoff],
-                        "crs": "EPSG:4326",
-                        "crs_transform": [1,0,0,0,1,0]
-                        },
-                        {
-                        "id": "N",
-                        "data_type": {
-                            "type": "PixelType",
-                            "precision": "double",
-                            "min": 0,
-                            "max": 255
-                        },
-                        "dimensions": [1,1],
-                        "origin": [xoff, yoff],
-                        "crs": "EPSG:4326",
-                        "crs_transform": [1,0,0,0,1,0]
-                        }
-                    ],
-                    "properties": {
-                        "system:footprint": {
-                        "geodesic": 'false',
-                        "type": "Polygon",
-                        "coordinates": [coordinates]
-                        },
-                        "system:time_start": unixdate,
-                        "system:time_end": unixdate,
-                        "description": "<p>The National Agriculture Imagery Program (NAIP) acquires aerial imagery\nduring the agricultural growing seasons in the continental U.S.</p><p>NAIP projects are contracted each year based upon available funding and the\nimagery acquisition cycle. Beginning in 2003, NAIP was acquired on\na 5-year cycle. 2008 was a transition year, and a three-year cycle began\nin 2009.</p><p>NAIP imagery is acquired at a one-meter ground sample distance (GSD) with a\nhorizontal accuracy that matches within six meters of photo-identifiable\nground control points, which are used during image inspection.</p><p>Older images were collected using 3 bands (Red, Green, and Blue: RGB), but\nnewer imagery is usually collected with an additional near-infrared band\n(RGBN). RGB asset ids begin with &#39;n<em>&#39;, NRG asset ids begin with &#39;c</em>&#39;, RGBN\nasset ids begin with &#39;m_&#39;.</p><p><b>Provider: <a href=\"https://www.fsa.usda.gov/programs-and-services/aerial-photography/imagery-programs/naip-imagery/\">USDA Farm Production and Conservation - Business Center, Geospatial Enterprise Operations</a></b><br><p><b>Resolution</b><br>1 meter\n</p><p><b>Bands</b><table class=\"eecat\"><tr><th scope=\"col\">Name</th><th scope=\"col\">Description</th></tr><tr><td>R</td><td><p>Red</p></td></tr><tr><td>G</td><td><p>Green</p></td></tr><tr><td>B</td><td><p>Blue</p></td></tr><tr><td>N</td><td><p>Near infrared</p></td></tr></table><p><b>Terms of Use</b><br><p>Most information presented on the FSA Web site is considered public domain\ninformation. Public domain information may be freely distributed or copied,\nbut use of appropriate byline/photo/image credits is requested. For more\ninformation visit the <a href=\"https://www.fsa.usda.gov/help/policies-and-links\">FSA Policies and Links</a>\nwebsite.</p><p>Users should acknowledge USDA Farm Production and Conservation -\nBusiness Center, Geospatial Enterprise Operations when using or\ndistributing this data set.</p><p><b>Suggested citation(s)</b><ul><li><p>USDA Farm Production and Conservation - Business Center, Geospatial Enterprise Operations</p></li></ul><style>\n  table.eecat {\n  border: 1px solid black;\n  border-collapse: collapse;\n  font-size: 13px;\n  }\n  table.eecat td, tr, th {\n  text-align: left; vertical-align: top;\n  border: 1px solid gray; padding: 3px;\n  }\n  td.nobreak { white-space: nowrap; }\n</style>"
-                    },
-                    "id": "image"
-                }
-
-                with open(outfile.parent / outfile.name.replace('-cog.tif', '-metadata.json'), 'w') as f:
-                    json.dump(metadata, f, indent=2)
+        # Warp on the fly into the destination grid so the tile is never
+        # held in memory; cog_translate copies the VRT one block window at
+        # a time and GDAL only fetches the source blocks it needs.
+        with WarpedVRT(
+            src,
+            crs=crs4326,
+            transform=dst_transform,
+            width=width,
+            height=height,
+            resampling=Resampling.bilinear,
+            warp_mem_limit=WARP_MEM_LIMIT,
+        ) as vrt:
+            print('Writing', outfile)
+            cog_translate(
+                vrt,
+                outfile,
+                cog_profile,
+                config=dict(GDAL_NUM_THREADS=COG_THREADS, GDAL_TIFF_OVR_BLOCKSIZE="512"),
+                overview_resampling="average",
+                in_memory=False,
+                quiet=True
+            )
+
+    # Generate and save preview
+    print('Writing preview ...')
+    # Change preview res to 30m. The decimated read is served from the local
+    # COG's overviews, so the remote source is not warped a second time.
+    new_h = max(1, int(height * res_y / 30))
+    new_w = max(1, int(width * res_x / 30))
+    with rasterio.open(outfile) as cog:
+        preview = cog.read(
+            indexes=[1, 2, 3],
+            out_shape=(3, new_h, new_w),
+            resampling=Resampling.average,
+        )
+    Image.fromarray(np.moveaxis(preview, 0, -1)).save(
+        outfile.parent / outfile.name.replace('-cog.tif', '-preview.png'),
+        optimize=True
+    )
+
+    # Generate and save metadata
+    print('Writing metadata ...')
+    xoff, yoff = (dst_transform.xoff, dst_transform.yoff)
+    coordinates = mapping(geom)['coordinates'][0][0]
+    date = datetime.strptime(
+        url.split('_')[-1].replace('.tif',''), "%Y%m%d")
+    unixdate = int(datetime.timestamp(date)*1000)
+
+    metadata = copy.deepcopy(NAIP_METADATA_TEMPLATE)
+    for band in metadata["bands"]:
+        band["origin"] = [xoff, yoff]
+    metadata["properties"]["system:footprint"]["coordinates"] = [coordinates]
+    metadata["properties"]["system:time_start"] = unixdate
+    metadata["properties"]["system:time_end"] = unixdate
+
+    (outfile.parent / outfile.name.replace('-cog.tif', '-metadata.json')).write_bytes(
+        orjson.dumps(metadata, option=orjson.OPT_INDENT_2)
+    )
+
+
+def fetch_cell(row, **kwargs):
+    """Run process_row in a worker, returning the exception instead of raising."""
+    try:
+        process_row(row, **kwargs)
+    except Exception as e:
+        return e
+
+
+if __name__ == "__main__":
+    if STATE == 'WA':
+        YEAR = '2021'
+        tindex_path = '/mnt/data/FESDataRepo/raw/noaa_naip/tileindex_WA_NAIP_2021.shp'
+        grid_path = '/mnt/data/FESDataRepo/stac_stands/interim/usgs_grid/USGS_CellGrid_3_75Minute_WA_epsg4326.geojson'
+        print('Fetching NAIP imagery for Washington St')
+    elif STATE == 'OR':
+        YEAR = '2020'
+        tindex_path = '/mnt/data/FESDataRepo/raw/noaa_naip/tile_index_OR_NAIP_2020_9504.shp'
+        grid_path = '/mnt/data/FESDataRepo/stac_stands/interim/usgs_grid/USGS_CellGrid_3_75Minute_OR_epsg4326.geojson'
+        print('Fetching NAIP imagery for Oregon')
+
+    grid = gpd.read_file(grid_path)
+
+    # The cell -> NAIP tile matching only changes when either input does, so
+    # reuse the last result unless the grid or tile index is newer.
+    cache = PROJDATADIR / f".cache/grid_tidx_{STATE}_{YEAR}.parquet"
+    key_mtime = max(os.path.getmtime(p) for p in (grid_path, tindex_path))
+    if cache.exists() and os.path.getmtime(cache) >= key_mtime:
+        cell_urls = pd.read_parquet(cache)
+    else:
+        # Get the overlap area of every intersecting cell/tile pair. Only
+        # the areas are needed, so candidate pairs come from the tile index's
+        # spatial index and are intersected in one vectorized call.
+        tindex = gpd.read_file(tindex_path).to_crs(crs2927)
+        tindex.columns = [c.upper() for c in tindex.columns if c != 'geometry'] + ['geometry']
+        cells = grid.to_crs(crs2927)
+        icell, itile = tindex.sindex.query(cells.geometry, predicate='intersects')
+        grid_tidx = pd.DataFrame({
+            'CELL_ID': cells.CELL_ID.to_numpy()[icell],
+            'URL': tindex.URL.to_numpy()[itile],
+            'area': shapely.area(shapely.intersection(
+                cells.geometry.to_numpy()[icell], tindex.geometry.to_numpy()[itile]
+            )),
+        })
+        # Pairs that only share an edge have no overlap, as in overlay
+        grid_tidx = grid_tidx[grid_tidx.area > 0]
+        # Keep the tile covering the largest part of each cell
+        grid_tidx = grid_tidx.loc[grid_tidx.groupby('CELL_ID')['area'].idxmax()]
+        cell_urls = grid_tidx[['CELL_ID', 'URL']].reset_index(drop=True)
+        cache.parent.mkdir(parents=True, exist_ok=True)
+        cell_urls.to_parquet(cache)
+
+    grid = grid.merge(cell_urls, on='CELL_ID').to_crs(crs4326)
+
+    labels = image_collection(PROJDATADIR / "labels", file_pattern='*.geojson')
+    cellids = [int(Path(x).name.split('_')[0]) for x in labels]
+
+    # Skip downloaded naip
+    downloaded = image_collection(PROJDATADIR / f"naip/{YEAR}", file_pattern='*.tif')
+    downloaded_cellids = [int(Path(x).name.split('_')[0]) for x in downloaded]
+    cellids = list(set(cellids) - set(downloaded_cellids))
+
+    grid = grid[grid.CELL_ID.isin(cellids)]
+
+    # Horizontal differencing compresses 8-bit imagery much better
+    cog_profile = cog_profiles.get("deflate")
+    cog_profile.update(dict(blockxsize=512, blockysize=512, predictor=2, zlevel=6))
+
+    out_dir = PROJDATADIR / f"naip/{YEAR}"
+    out_dir.mkdir(parents=True, exist_ok=True)
+    rows = [
+        {'CELL_ID': cellid, 'URL': url, 'geometry': geom}
+        for cellid, url, geom in zip(grid.CELL_ID, grid.URL, grid.geometry)
+    ]
+    fetch = partial(
+        fetch_cell, year=YEAR, state=STATE, out_dir=out_dir, cog_profile=cog_profile
+    )
+    with ProcessPoolExecutor(max_workers=WORKERS) as ex:
+        for cellid, err in zip((r['CELL_ID'] for r in rows), ex.map(fetch, rows)):
+            if err is not None:
+                print(f"Failed to fetch {cellid}: {err}")
@@ -4,13 +4,14 @@ Validate the dataset by checking for empty images and errors while reading image
 
 # %%
 import os
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 import rasterio
+from rasterio.enums import Resampling
 import pandas as pd
 from forestsegnet.utils import (
     image_collection,
     ConfigLoader,
-    multithreaded_execution
 )
 
 # Suppress errors
@@ -18,6 +19,44 @@ from forestsegnet.utils import (
 from osgeo import gdal
 gdal.PushErrorHandler('CPLQuietErrorHandler')
 
+# Skip sibling-directory listings on open, which dominate latency on S3
+GDAL_READ_OPTIONS = {
+    'GDAL_DISABLE_READDIR_ON_OPEN': 'EMPTY_DIR',
+    'CPL_VSIL_CURL_ALLOWED_EXTENSIONS': '.tif',
+    'GDAL_CACHEMAX': '512',
+}
+
+# GDAL serializes reads behind its block cache lock, so use processes.
+# About 20 GDAL workers is where scaling flattens out.
+WORKERS = min(20, os.cpu_count() or 1)
+
+
+def _init_gdal():
+    """Set up GDAL in each worker process."""
+    gdal.PushErrorHandler('CPLQuietErrorHandler')
+    gdal.SetConfigOption('GDAL_CACHEMAX', GDAL_READ_OPTIONS['GDAL_CACHEMAX'])
+
+
+def check_empty(img):
+    error_reading = 0
+    is_empty = 0
+    img_path = Path(img)
+    try:
+        with rasterio.Env(**GDAL_READ_OPTIONS), rasterio.open(img) as src:
+            # A decimated read is served from the COG overviews, so only a
+            # few blocks are decoded instead of the full raster. Overviews
+            # can still round sparse values away, so a zero result is
+            # confirmed with a full read before flagging the image.
+            out_shape = (src.count, min(64, src.height), min(64, src.width))
+            data = src.read(out_shape=out_shape, resampling=Resampling.max)
+            if data.sum() == 0 and src.read().sum() == 0:
+                is_empty = 1
+    except:
+        error_reading = 1
+
+    return (img_path.parent, img_path.name, error_reading, is_empty)
+
+
 def main():
     conf = ConfigLoader(Path(__file__).parent.parent).load()
     # root = Path(conf.PROJDIR) / 'data/dev'
@@ -25,21 +64,7 @@ def main():
 
     print('Validating images...')
 
-    images = [{'img': i} for i in image_collection(root)]
-
-    def check_empty(img):
-        error_reading = 0
-        is_empty = 0
-        img_path = Path(img)
-        try:
-            with rasterio.open(img) as src:
-                data = src.read()
-                if data.sum() == 0:
-                    is_empty = 1
-        except:
-            error_reading = 1
-
-        return (img_path.parent, img_path.name, error_reading, is_empty)
+    images = image_collection(root)
 
     def has_metadata(img):
         img_path = Path(img)
@@ -49,8 +74,9 @@ def main():
             return img_path.as_posix()
         return None
     
-    results = multithreaded_execution(check_empty, images, 8)
-    # nopath = multithreaded_execution(has_metadata, images, 8)
+    with ProcessPoolExecutor(max_workers=WORKERS, initializer=_init_gdal) as ex:
+        results = list(ex.map(check_empty, images, chunksize=64))
+    # nopath = multithreaded_execution(has_metadata, [{'img': i} for i in images], 8)
 
     df = pd.DataFrame(results, columns=['folder', 'image', 'error_reading', 'is_empty'])
     empty = df.is_empty.sum()